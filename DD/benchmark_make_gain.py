@@ -0,0 +1,162 @@
+"""
+Benchmark make_gain_multithreaded.py on synthetic data, no real data or network needed.
+
+A small measurement set (only the ANTENNA and FIELD information that make_gain_multithreaded.py
+reads) and a multi-direction h5parm with smooth phase and amplitude screens are fabricated,
+after which make_gain_multithreaded.py is run for every combination of the requested options.
+Wall time, peak RSS (of the largest process) and output size are reported per run.
+
+EXAMPLE:
+python benchmark_make_gain.py --ndir 40 --nstations 30 --ntimes 300 --nfreqs 4 --size 64 --ncpu 1 8 --timeblocks 1 4 --padding False True --smoothamps False True
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import casacore.tables as ct
+import numpy as np
+from losoto.h5parm import h5parm
+
+MAKE_GAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'make_gain_multithreaded.py')
+
+
+def synthetic_stations(nstations):
+    '''
+        LOFAR-like station names: half core stations, half remote stations
+    '''
+    ncore = nstations//2
+    return ['CS{:03d}LBA'.format(i+1) for i in range(ncore)] + ['RS{:03d}LBA'.format(i+101) for i in range(nstations - ncore)]
+
+def make_synthetic_ms(msname, stations, phasecenter):
+    '''
+        Create an empty measurement set with the antenna names and phase center filled in
+    '''
+    t = ct.default_ms(msname)
+    t.close()
+    ant = ct.table(msname + '/ANTENNA', readonly=False, ack=False)
+    ant.addrows(len(stations))
+    ant.putcol('NAME', stations)
+    ant.close()
+    field = ct.table(msname + '/FIELD', readonly=False, ack=False)
+    field.addrows(1)
+    for col in ['REFERENCE_DIR', 'PHASE_DIR', 'DELAY_DIR']:
+        field.putcol(col, np.array([[phasecenter]]))
+    field.close()
+
+def make_synthetic_h5(h5name, stations, ndir, ntimes, nfreqs, phasecenter, boxwidth, includeamps=True, seed=1):
+    '''
+        Create a multi-direction h5parm (phase000 and amplitude000) with a smooth random screen per station
+        The directions are placed inside the screen area, the core stations get ST001 solutions
+    '''
+    rng = np.random.default_rng(seed)
+    h5_stations = ['ST001'] + [station for station in stations if not station.startswith('CS')]
+    directions = ['Dir{:02d}'.format(i) for i in range(ndir)]
+    dra, ddec = np.deg2rad(rng.uniform(-0.45*boxwidth, 0.45*boxwidth, size=(2, ndir)))
+    ra = phasecenter[0] + dra/np.cos(phasecenter[1])
+    dec = phasecenter[1] + ddec
+
+    times = 4.8e9 + 8.*np.arange(ntimes)
+    freqs = np.linspace(15e6, 30e6, nfreqs)
+
+    # phases: a gradient over the field per station, varying slowly in time, plus noise
+    tt = np.linspace(0, 2.*np.pi, ntimes)[:, None, None, None]
+    grad = rng.normal(size=(2, len(h5_stations)))[:, None, None, :, None]
+    phases = (grad[0]*np.cos(tt) + grad[1]*np.sin(tt))*dra[None, None, None, :]/np.deg2rad(boxwidth)
+    phases = phases*(freqs[0]/freqs)[None, :, None, None] + 0.05*rng.normal(size=(ntimes, nfreqs, len(h5_stations), ndir))
+    phases = np.repeat(phases[..., None], 2, axis=-1)
+    amps = 1. + 0.1*rng.normal(size=phases.shape)
+    amps[..., 1] = amps[..., 0]
+
+    h5 = h5parm(h5name, readonly=False)
+    solset = h5.makeSolset('sol000')
+    solset.obj._f_get_child('antenna').append([(station, [0., 0., 0.]) for station in h5_stations])
+    solset.obj._f_get_child('source').append([(d, [r, de]) for d, r, de in zip(directions, ra, dec)])
+    axesNames = ['time', 'freq', 'ant', 'dir', 'pol']
+    axesVals = [times, freqs, h5_stations, directions, ['XX', 'YY']]
+    solset.makeSoltab('phase', 'phase000', axesNames=axesNames, axesVals=axesVals, vals=phases, weights=np.ones_like(phases))
+    if includeamps:
+        solset.makeSoltab('amplitude', 'amplitude000', axesNames=axesNames, axesVals=axesVals, vals=amps, weights=np.ones_like(amps))
+    h5.close()
+
+def run_make_gain(workdir, options, quiet=True):
+    '''
+        Run make_gain_multithreaded.py in workdir, returns wall time, peak RSS (MB) and output size (MB)
+    '''
+    cmd = [sys.executable, MAKE_GAIN] + options
+    log = open(os.path.join(workdir, 'make_gain.log'), 'w')
+    starttime = time.time()
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=log if quiet else None, stderr=subprocess.STDOUT if quiet else None)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    walltime = time.time() - starttime
+    log.close()
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError('Failed: ' + ' '.join(cmd) + ', see ' + log.name)
+    outputsize = sum([os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir) if f.startswith('benchscreen')])
+    return walltime, rusage.ru_maxrss/1024., outputsize/1024.**2
+
+
+if __name__ == '__main__':
+    def str2bool(v):
+        return str(v).lower() in ('yes', 'true', 't', 'y', '1')
+
+    parser = argparse.ArgumentParser(description='Benchmark make_gain_multithreaded.py on synthetic h5parms')
+    parser.add_argument('--ndir', help='Number of directions', type=int, default=20)
+    parser.add_argument('--nstations', help='Number of stations in the measurement set', type=int, default=24)
+    parser.add_argument('--ntimes', help='Number of solution times', type=int, default=100)
+    parser.add_argument('--nfreqs', help='Number of solution frequencies', type=int, default=2)
+    parser.add_argument('--size', help='Screen sizes in pixels', type=int, nargs='+', default=[64])
+    parser.add_argument('--boxwidth', help='Size of the screen in degrees', type=float, default=2.5)
+    parser.add_argument('--ncpu', help='Values of --ncpu to benchmark', type=int, nargs='+', default=[1])
+    parser.add_argument('--timeblocks', help='Values of --timeblocks to benchmark', type=int, nargs='+', default=[1])
+    parser.add_argument('--padding', help='Values of --padding to benchmark', type=str2bool, nargs='+', default=[False])
+    parser.add_argument('--smoothamps', help='Values of --smoothamps to benchmark', type=str2bool, nargs='+', default=[False])
+    parser.add_argument('--outputformat', help='Values of --outputformat to benchmark', type=str, nargs='+', default=['fits'])
+    parser.add_argument('--repeat', help='Number of times every run is repeated, the fastest is reported', type=int, default=1)
+    parser.add_argument('--workdir', help='Directory for the synthetic data and outputs, default is a temporary directory', type=str, default=None)
+    parser.add_argument('--results', help='Write the results to this JSON file', type=str, default=None)
+    parser.add_argument('--seed', help='Random seed for the synthetic solutions', type=int, default=1)
+    parser.add_argument('--verbose', help='Show the output of make_gain_multithreaded.py', action='store_true')
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='benchmark_make_gain_')
+    os.makedirs(workdir, exist_ok=True)
+    phasecenter = np.deg2rad([123.4, 56.7])
+    stations = synthetic_stations(args.nstations)
+    msname = os.path.join(workdir, 'synthetic.ms')
+    h5name = os.path.join(workdir, 'synthetic.h5')
+    print('Creating synthetic data in', workdir)
+    make_synthetic_ms(msname, stations, phasecenter)
+    make_synthetic_h5(h5name, stations, args.ndir, args.ntimes, args.nfreqs, phasecenter, args.boxwidth, seed=args.seed)
+
+    results = []
+    print('{:>5s} {:>5s} {:>10s} {:>8s} {:>10s} {:>7s} {:>10s} {:>10s} {:>12s}'.format('size', 'ncpu', 'timeblocks', 'padding', 'smoothamps', 'format', 'wall [s]', 'RSS [MB]', 'output [MB]'))
+    for size, ncpu, timeblocks, padding, smoothamps, outputformat in itertools.product(args.size, args.ncpu, args.timeblocks, args.padding, args.smoothamps, args.outputformat):
+        rundir = os.path.join(workdir, 'run_{:d}_{:d}_{:d}_{:d}_{:d}_{:s}'.format(size, ncpu, timeblocks, padding, smoothamps, outputformat))
+        options = ['--H5file', h5name, '--ms', msname, '--size', str(size), '--boxwidth', str(args.boxwidth),
+                   '--ncpu', str(ncpu), '--timeblocks', str(timeblocks), '--padding', str(padding),
+                   '--outputformat', outputformat, '--FITSscreen', 'benchscreen.fits']
+        if smoothamps:
+            options.append('--smoothamps')
+        timings = []
+        for i in range(args.repeat):
+            shutil.rmtree(rundir, ignore_errors=True)
+            os.makedirs(rundir)
+            timings.append(run_make_gain(rundir, options, quiet=not args.verbose))
+        walltime, maxrss, outputsize = min(timings)
+        results.append({'size': size, 'ncpu': ncpu, 'timeblocks': timeblocks, 'padding': padding, 'smoothamps': smoothamps,
+                        'outputformat': outputformat, 'walltime': walltime, 'maxrss_mb': maxrss, 'output_mb': outputsize,
+                        'ndir': args.ndir, 'nstations': args.nstations, 'ntimes': args.ntimes, 'nfreqs': args.nfreqs})
+        print('{:5d} {:5d} {:10d} {:>8s} {:>10s} {:>7s} {:10.2f} {:10.1f} {:12.1f}'.format(size, ncpu, timeblocks, str(padding), str(smoothamps), outputformat, walltime, maxrss, outputsize))
+
+    if args.results is not None:
+        with open(args.results, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
+    if args.workdir is None:
+        shutil.rmtree(workdir)
@@ -11,6 +11,10 @@ merge_h5(h5_out='test.h5',
         ms_files='*.ms',
         convert_tec=True)
 
+To do several merges (for example one per measurement set), use merge_h5_jobs
+with a list of (h5_out, h5_tables, ms_files), or on the command line:
+python h5_merger.py -out 'merged.{n}.h5' -in '*.{n}.h5' -ms 'Dir0.{n}.ms' --numbers 0 1 2
+
 Following input parameters are possible:
 h5_out ---> the output name of the h5 table
 h5_tables ---> h5 tables that have to be merged
@@ -20,6 +24,12 @@ convert_tec ---> convert tec to phase
 merge_all_in_one ---> merge all in one direction (default is False), if True it adds everything in one direction
 lin2circ ---> convert linear to circular polarization (default is False)
 circ2lin ---> convert circular to linear polarization (default is False)
+write_block ---> size in MB of the slices in which the output solution tables are written (default is 1024)
+
+Memory: the merge is not out-of-core. The input tables are read one direction at a time, but the merged
+solutions (time, freq, ant, dir, pol) of a solution table and their temporary copies are held in memory in full,
+so the peak memory grows with the size of the output and is not limited by write_block. write_block only
+limits the size of the slices that are written to the output h5 (and of the extra weight array).
 """
 
 # TODO: test rotation (fulljones)
@@ -29,26 +39,61 @@ circ2lin ---> convert circular to linear polarization (default is False)
 __author__ = "Jurjen de Jong (jurjendejong@strw.leidenuniv.nl)"
 
 import os
-from casacore import tables as ct
 from glob import glob
 from losoto.h5parm import h5parm
 from losoto.lib_operations import reorderAxes
-from scipy.interpolate import interp1d
 import sys
 import re
 import tables
-from numpy import zeros, ones, round, unique, array_equal, append, where, isfinite, expand_dims, pi, array
+import multiprocessing as mp
+# ms_metadata.py lives in lofar_facet_selfcal, LoDeSS copies it next to this file in the DD_cal folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lofar_facet_selfcal'))
+from ms_metadata import ms_metadata
+from functools import partial
+from numpy import zeros, ones, round, array_equal, append, where, isfinite, expand_dims, pi, array, argsort, \
+    searchsorted, repeat, take, prod
+
+__all__ = ['merge_h5', 'merge_h5_jobs', 'str2bool']
 
-__all__ = ['merge_h5', 'str2bool']
+# cache for metadata that is shared between merges, filled before forking in merge_h5_jobs
+# (the measurement set axes are cached by ms_metadata)
+_h5_sources = {}  # (h5 name, modification time, solset) --> source dictionary
 
 def remove_numbers(inp):
     return "".join(re.findall("[a-zA-z]+", inp))
 
+def read_ms_axes(ms):
+    """
+    Read the time and frequency axis of a measurement set, every measurement set is only read once
+    :param ms: measurement set name
+    :return time axis, frequency axis
+    """
+    return list(ms_metadata(ms, 'times')), ms_metadata(ms, 'chan_freq')[0]
+
+def read_sources(h5_name, solset, ss=None):
+    """
+    Read the source table of a solution set, every (unchanged) h5 table is only read once
+    :param h5_name: h5 table name
+    :param solset: solution set name
+    :param ss: opened solution set, to avoid opening the h5 table again
+    :return source dictionary
+    """
+    key = (os.path.abspath(h5_name), os.path.getmtime(h5_name), solset)
+    if key not in _h5_sources:
+        if ss is None:
+            h5 = h5parm(h5_name)
+            _h5_sources[key] = h5.getSolset(solset).getSou()
+            h5.close()
+        else:
+            _h5_sources[key] = ss.getSou()
+    return _h5_sources[key]
+
 
 class MergeH5:
     """Merge multiple h5 tables"""
 
-    def __init__(self, h5_out, h5_tables=None, ms_files=None, h5_time_freq=None, convert_tec=True, merge_all_in_one=False):
+    def __init__(self, h5_out, h5_tables=None, ms_files=None, h5_time_freq=None, convert_tec=True, merge_all_in_one=False,
+                 write_block=1024):
         """
         :param h5_out: name of merged output h5 table
         :param files: h5 tables to merge, can be both list and string
@@ -56,6 +101,8 @@ class MergeH5:
         :param h5_time_freq: read time and frequency from h5
         :param convert_tec: convert TEC to phase or not
         :param merge_all_in_one: merge all in one direction
+        :param write_block: size in MB of the slices in which the output solution tables are written,
+                            this does not limit the memory of the merge (see the module docstring)
         """
 
         self.file = h5_out
@@ -83,13 +130,7 @@ class MergeH5:
             self.ax_freq = T.root.sol000.phase000.freq[:]
             T.close()
         elif len(ms) > 0:  # check if there is a valid ms file
-            t = ct.taql('SELECT CHAN_FREQ, CHAN_WIDTH FROM ' + ms[0] + '::SPECTRAL_WINDOW')
-            self.ax_freq = t.getcol('CHAN_FREQ')[0]
-            t.close()
-
-            t = ct.table(ms[0])
-            self.ax_time = sorted(unique(t.getcol('TIME')))
-            t.close()
+            self.ax_time, self.ax_freq = read_ms_axes(ms[0])
 
         else:  # if we dont have ms files, we use the time and frequency axis of the longest h5 table
             print('No MS file given, will use h5 table for frequency and time axis')
@@ -115,6 +156,7 @@ class MergeH5:
 
         self.convert_tec = convert_tec  # convert tec or not
         self.merge_all_in_one = merge_all_in_one
+        self.write_block = write_block
 
         self.solaxnames = ['pol', 'dir', 'ant', 'freq', 'time']  # standard solax order to do our manipulations
 
@@ -122,8 +164,8 @@ class MergeH5:
 
     def get_values(self, st, solset, soltab):
         """
-        Get the values from the h5 table to merge.
-        Also do some checks on the time and frequency axis.
+        Do some checks on the time and frequency axis of the h5 table to merge.
+        The values themselves are read per direction with get_direction_values.
         :param st: solution table
         :param solset: solset name
         :param soltab: soltab name
@@ -140,7 +182,7 @@ class MergeH5:
         else:
             freq_axes = self.ax_freq
 
-        print('Value shape before --> {values}'.format(values=st.getValues()[0].shape))
+        print('Value shape before --> {values}'.format(values=st.obj.val.shape))
 
         if self.ax_time[0] > time_axes[-1] or time_axes[0] > self.ax_time[-1]:
             print("WARNING: Time axes of h5 and MS are not overlapping.")
@@ -152,9 +194,22 @@ class MergeH5:
         for av in self.axes_new:
             if av in st.getAxesNames() and st.getAxisLen(av) == 0:
                 print("No {av} in {solset}/{soltab}".format(av=av, solset=solset, soltab=soltab))
-        values = reorderAxes(st.getValues()[0], st.getAxesNames(), self.axes_current)
 
-        return values, time_axes, freq_axes
+        return time_axes, freq_axes
+
+    @staticmethod
+    def get_direction_values(st, dir_idx, axes):
+        """
+        Read the values of a single direction straight from the pytables array,
+        so only one direction of the solution table is in memory.
+        :param st: solution table
+        :param dir_idx: direction index
+        :param axes: axes order of the returned values (direction axis has length 1)
+        """
+        slicer = [slice(None)] * len(st.getAxesNames())
+        slicer[st.getAxesNames().index('dir')] = slice(dir_idx, dir_idx + 1)
+        values = st.obj.val[tuple(slicer)].astype(float)
+        return reorderAxes(values, st.getAxesNames(), axes)
 
     def sort_soltabs(self, soltabs):
         """
@@ -194,14 +249,18 @@ class MergeH5:
     def get_allkeys(self):
         """
         Get all solution sets, solutions tables, and ax names in lists.
+        This also plans the output directions: all unique source coordinates are collected up front,
+        so the merged solutions can be allocated once with the final number of directions.
         """
         self.all_soltabs, self.all_solsets, self.all_axes, self.antennas = [], [], [], []
+        table_sources = []  # (soltab, source coordinates) in the order of the h5 tables
 
         for h5_name in self.h5_tables:
             h5 = h5parm(h5_name)
             for solset in h5.getSolsetNames():
                 self.all_solsets += [solset]
                 ss = h5.getSolset(solset)
+                sources = read_sources(h5_name, solset, ss)
                 for n, soltab in enumerate(ss.getSoltabNames()):
                     self.all_soltabs += [soltab]
                     st = ss.getSoltab(soltab)
@@ -210,12 +269,29 @@ class MergeH5:
                         self.antennas = st.getAxisValues('ant')  # check if same for all h5
                     elif list(self.antennas) != list(st.getAxisValues('ant')):
                         sys.exit('ERROR: antennas not the same')
+                    if '000' in solset and 'dir' in st.getAxesNames() and not self.merge_all_in_one:
+                        table_sources.append((soltab, [sources[k] for k in list(sources.keys())[:st.getAxisLen('dir')]]))
             h5.close()
         self.all_soltabs = self.sort_soltabs(self.all_soltabs)
+        # plan only the directions of the solution tables that are merged (no tec if convert_tec=False)
+        merged_soltabs = [soltab for st_group in self.all_soltabs for soltab in st_group]
+        for soltab, source_coords in table_sources:
+            if soltab in merged_soltabs:
+                self.plan_directions(source_coords)
         self.all_solsets = set(self.all_solsets)
         self.all_axes = set(self.all_axes)
         return self
 
+    def plan_directions(self, source_coords):
+        """
+        Add directions that do not exist yet (compared by source coordinates), in the same order as get_sol finds them
+        :param source_coords: list with source coordinates
+        """
+        for coords in source_coords:
+            if not any([array_equal(coords, list(sv)) for sv in self.directions.values()]):
+                self.directions.update({'Dir{:02d}'.format(len(self.directions)): coords})
+        return self
+
     def get_clean_values(self, soltab, st):
         """
         Get default values, based on model h5 table
@@ -248,7 +324,8 @@ class MergeH5:
         else:
             self.phases = zeros((num_dir, len(self.antennas), len(self.ax_freq), len(self.ax_time)))
 
-        self.n = 0  # direction number reset
+        # direction number, new directions are added after the planned directions
+        self.n = 0 if self.merge_all_in_one else len(self.directions)
 
         return self
 
@@ -262,6 +339,22 @@ class MergeH5:
         """
         return -8.4479745e9 * tec / freqs
 
+    @staticmethod
+    def nearest_index(interp_from, interp_to):
+        """
+        Index map for nearest neighbour interpolation, same result as interp1d(kind='nearest', fill_value='extrapolate').
+        Compute it once per axis and apply it with take to all values on that axis.
+        :param interp_from: interpolate from this axis
+        :param interp_to: interpolate to this axis
+        :return indices in interp_from for every value of interp_to
+        """
+        interp_from = array(interp_from, dtype=float)
+        order = argsort(interp_from, kind='mergesort')
+        sorted_from = interp_from[order]
+        bounds = (sorted_from[1:] + sorted_from[:-1]) / 2.
+        idx = searchsorted(bounds, array(interp_to, dtype=float), side='left').clip(0, len(sorted_from) - 1)
+        return order[idx]
+
     @staticmethod
     def interp_along_axis(x, interp_from, interp_to, axis):
         """
@@ -272,9 +365,7 @@ class MergeH5:
         :param axis: interpolation axis
         :return return the interpolated result
         """
-        interp_vals = interp1d(interp_from, x, axis=axis, kind='nearest', fill_value='extrapolate')
-        new_vals = interp_vals(interp_to)
-        return new_vals
+        return take(x, MergeH5.nearest_index(interp_from, interp_to), axis=axis)
 
     def get_model_h5(self, solset, soltab):
         """
@@ -322,8 +413,7 @@ class MergeH5:
         Get number of directions in solution table
         :param st: solution table
         """
-        dir_index = st.getAxesNames().index('dir')
-        return st.getValues()[0].shape[dir_index]
+        return st.getAxisLen('dir')
 
     def get_sol(self, solset, soltab):
         """
@@ -355,25 +445,17 @@ class MergeH5:
             print('This table has {numdirection} direction(s)'.format(numdirection=num_dirs))
 
 
-            # get values, time, and freq axis
-            table_values, time_axes, freq_axes = self.get_values(st, solset, soltab)
+            # get time and freq axis, the values are read per direction
+            time_axes, freq_axes = self.get_values(st, solset, soltab)
+            # nearest neighbour index maps onto the output axes, the same for all directions of this table
+            time_idx = self.nearest_index(time_axes, self.ax_time)
+            freq_idx = self.nearest_index(freq_axes, self.ax_freq)
+            table_axes = list(self.axes_current)
+            sources = read_sources(h5_name, solset, ss)
 
             for dir_idx in range(num_dirs):#loop over all directions
 
-                shape = list(table_values.shape)
-                shape[dir_index] = 1
-                values = zeros(shape)
-
-                if dir_index == 0:
-                    values[0, ...] += table_values[dir_idx, ...]
-                elif dir_index == 1:
-                    values[:, 0, ...] += table_values[:, dir_idx, ...]
-                elif dir_index == 2:
-                    values[:, :, 0, ...] += table_values[:, :, dir_idx, ...]
-                elif dir_index == 3:
-                    values[:, :, :, 0, ...] += table_values[:, :, :, dir_idx, ...]
-                elif dir_index == 4:
-                    values[:, :, :, :, 0, ...] += table_values[:, :, :, :, dir_idx, ...]
+                values = self.get_direction_values(st, dir_idx, table_axes)
 
                 # update current and new axes if missing pol axes
                 if len(self.axes_current) == 4 and ((len(self.phases.shape) == 5
@@ -385,8 +467,7 @@ class MergeH5:
                         self.axes_new = ['pol'] + self.axes_new
 
                 # get source coordinates
-                d = ss.getSou()
-                source_coords = d[list(d.keys())[dir_idx]]
+                source_coords = sources[list(sources.keys())[dir_idx]]
 
                 d = 'Dir{:02d}'.format(self.n)
 
@@ -436,11 +517,9 @@ class MergeH5:
                             self.axes_current = ['dir', 'ant', 'freq', 'time']
                         else:
                             self.axes_current = ['pol', 'dir', 'ant', 'freq', 'time']
-                        valuestmp = values
-                        for _ in range(len(self.ax_freq)-1):
-                            values = append(values, valuestmp, axis=-2)
+                        # the frequency axis has length 1 now, the conversion below broadcasts it to ax_freq
 
-                    if self.convert_tec:  # Convert tec to phase.
+                    if self.convert_tec:  # Convert tec to phase, time is the last axis and is regridded before the conversion.
                         if len(self.polarizations) > 0 and len(self.phases.shape) == 5 and 'pol' not in self.axes_current:
                             valtmp = ones((len(self.polarizations),) + values.shape)
                             valtmp[0, ...] = values
@@ -448,19 +527,13 @@ class MergeH5:
                             values = valtmp
 
                             freqs = self.ax_freq.reshape(1, 1, 1, -1, 1)
-                            tecphase = self.tecphase_conver(values, freqs)
-                            tp = self.interp_along_axis(tecphase, time_axes, self.ax_time,
-                                                        self.axes_new.index('time'))
+                            tp = self.tecphase_conver(take(values, time_idx, axis=-1), freqs)
                         elif len(self.phases.shape) == 4:
                             freqs = self.ax_freq.reshape(1, 1, -1, 1)
-                            tecphase = self.tecphase_conver(values, freqs)
-                            tp = self.interp_along_axis(tecphase, time_axes, self.ax_time,
-                                                        self.axes_current.index('time'))
+                            tp = self.tecphase_conver(take(values, time_idx, axis=-1), freqs)
                         elif len(self.phases.shape) == 5:
                             freqs = self.ax_freq.reshape(1, 1, 1, -1, 1)
-                            tecphase = self.tecphase_conver(values, freqs)
-                            tp = self.interp_along_axis(tecphase, time_axes, self.ax_time,
-                                                        self.axes_current.index('time'))
+                            tp = self.tecphase_conver(take(values, time_idx, axis=-1), freqs)
                         else:
                             sys.exit('ERROR: Something went wrong with reshaping. Shouldnt end up here..')
                         # Make tp shape same as phases
@@ -500,7 +573,7 @@ class MergeH5:
                         if 'dir' in self.axes_current:  # this line is trivial and could maybe be removed
                             values = values[0, :, 0, :]
 
-                        tp = self.interp_along_axis(values, time_axes, self.ax_time, -1)
+                        tp = take(values, time_idx, axis=-1)
                         tp = tp.reshape((1, tp.shape[0], 1, tp.shape[1]))
                         # Now add the tecs to the total phase correction for this direction.
                         if 'dir' in self.axes_current:  # this line is trivial and could be removed
@@ -539,16 +612,12 @@ class MergeH5:
                     idxnan = where((~isfinite(values)))
                     values[idxnan] = 0.0
 
-                    tp = self.interp_along_axis(values, time_axes, self.ax_time,
-                                                self.axes_current.index('time'))
+                    tp = take(values, time_idx, axis=self.axes_current.index('time'))
 
                     if tp.shape[-2] == 1:
-                        tptmp = tp
-                        for _ in self.ax_freq[:-1]:
-                            tp = append(tp, tptmp, axis=-2)
+                        tp = repeat(tp, len(self.ax_freq), axis=-2)
                     else:
-                        tp = self.interp_along_axis(tp, freq_axes, self.ax_freq,
-                                                    self.axes_current.index('freq'))
+                        tp = take(tp, freq_idx, axis=self.axes_current.index('freq'))
 
                     if len(self.phases.shape) == 5 and self.phases.shape[0] == 1:
                         phasetmp = zeros((2,) + self.phases.shape[1:])
@@ -609,16 +678,12 @@ class MergeH5:
 
                     idxnan = where((~isfinite(values)))
                     values[idxnan] = 1.0
-                    tp = self.interp_along_axis(values, time_axes, self.ax_time,
-                                                self.axes_current.index('time'))
+                    tp = take(values, time_idx, axis=self.axes_current.index('time'))
 
                     if tp.shape[-2] == 1:
-                        tptmp = tp
-                        for _ in self.ax_freq[:-1]:
-                            tp = append(tp, tptmp, axis=-2)
+                        tp = repeat(tp, len(self.ax_freq), axis=-2)
                     else:
-                        tp = self.interp_along_axis(tp, freq_axes, self.ax_freq,
-                                                    self.axes_current.index('freq'))
+                        tp = take(tp, freq_idx, axis=self.axes_current.index('freq'))
 
                     if len(self.gains.shape) == 5 and self.gains.shape[0] == 1:
                         gaintmp = zeros((2,) + self.gains.shape[1:])
@@ -785,15 +850,11 @@ class MergeH5:
 
         # make new solution table
         if 'phase' in soltab:
-            weights = ones(self.phases.shape)
-            print('Value shape after --> {values}'.format(values=weights.shape))
-            solsetout.makeSoltab('phase', axesNames=self.axes_new, axesVals=axes_vals, vals=self.phases,
-                                 weights=weights)
+            print('Value shape after --> {values}'.format(values=self.phases.shape))
+            self.write_soltab(solsetout, 'phase', self.axes_new, axes_vals, self.phases)
         if 'amplitude' in soltab:
-            weights = ones(self.gains.shape)
-            print('Value shape after --> {values}'.format(values=weights.shape))
-            solsetout.makeSoltab('amplitude', axesNames=self.axes_new, axesVals=axes_vals, vals=self.gains,
-                                 weights=weights)
+            print('Value shape after --> {values}'.format(values=self.gains.shape))
+            self.write_soltab(solsetout, 'amplitude', self.axes_new, axes_vals, self.gains)
         if 'tec' in soltab:
             print('ADD TEC')
             if self.axes_new.index('freq') == 1:
@@ -802,16 +863,189 @@ class MergeH5:
                 self.phases = self.phases[:, :, :, 0]
             else:
                 self.phases = self.phases[:, :, 0, :]
-            weights = ones(self.phases.shape)
-            print('Value shape after --> {values}'.format(values=weights.shape))
-            solsetout.makeSoltab('tec', axesNames=['dir', 'ant', 'time'],
-                                 axesVals=[self.ax_time, self.antennas, list(self.directions.keys())],
-                                 vals=self.phases, weights=weights)
+            print('Value shape after --> {values}'.format(values=self.phases.shape))
+            self.write_soltab(solsetout, 'tec', ['dir', 'ant', 'time'],
+                              [list(self.directions.keys()), self.antennas, self.ax_time], self.phases)
 
         print('DONE: {solset}/{soltab}'.format(solset=solset, soltab=soltab))
         self.h5_out.close()
         return self
 
+    def solution_array(self, T, soltab_node, name, shape, axes_names):
+        """
+        Create an empty chunked and compressed val/weight array that is extended along the dir axis.
+        One chunk holds a single direction and about 1 MB of data.
+        :param T: pytables file
+        :param soltab_node: solution table group
+        :param name: array name
+        :param shape: final shape of the array
+        :param axes_names: axes names
+        """
+        dir_axis = axes_names.index('dir')
+        other_axis = axes_names.index('time') if 'time' in axes_names else (dir_axis + 1) % len(shape)
+        chunkshape = [max(s, 1) for s in shape]
+        chunkshape[dir_axis] = 1
+        other_size = int(prod(chunkshape)) // chunkshape[other_axis] * 8
+        chunkshape[other_axis] = int(min(max(2 ** 20 // other_size, 1), chunkshape[other_axis]))
+        earray_shape = list(shape)
+        earray_shape[dir_axis] = 0
+        earray = T.create_earray(soltab_node, name, atom=tables.Float64Atom(), shape=tuple(earray_shape),
+                                 chunkshape=tuple(chunkshape), expectedrows=max(shape[dir_axis], 1),
+                                 filters=tables.Filters(complevel=5, complib='zlib', shuffle=True))
+        earray.attrs['AXES'] = ','.join(axes_names).encode()
+        return earray
+
+    def directions_per_block(self, shape, dir_axis):
+        """
+        Number of directions of a val and weight array of this shape that fit in one write slice
+        """
+        dir_size = max(int(prod(shape)) // max(shape[dir_axis], 1), 1) * 8
+        return int(max(self.write_block * 2 ** 20 // (2 * dir_size), 1))
+
+    def write_soltab(self, solsetout, soltype, axes_names, axes_vals, values):
+        """
+        Write a solution table with pytables in the same layout as losoto's makeSoltab, but with chunked and
+        compressed val/weight arrays that are filled in blocks of directions.
+        The values are written in slices of at most write_block MB, so this step does not add a full size weight
+        array or copy of the values. The merged values themselves are already in memory in full.
+        The arrays can be extended along the dir axis afterwards (see post_process).
+        :param solsetout: output solution set
+        :param soltype: solution type (phase, amplitude, tec)
+        :param axes_names: axes names in the order of values
+        :param axes_vals: axes values in the order of values
+        :param values: solution values
+        """
+        shape = values.shape
+        for axis_name, axis_vals, axis_len in zip(axes_names, axes_vals, shape):
+            if len(axis_vals) != axis_len:
+                raise ValueError('{soltype}: axis {axis} has {n_vals} values, but the solutions have length {n} along this axis'
+                                 .format(soltype=soltype, axis=axis_name, n_vals=len(axis_vals), n=axis_len))
+
+        soltab_names = solsetout.getSoltabNames()
+        n = 0
+        while '{soltype}{n:03d}'.format(soltype=soltype, n=n) in soltab_names:
+            n += 1
+        soltab_name = '{soltype}{n:03d}'.format(soltype=soltype, n=n)
+
+        T = solsetout.obj._v_file
+        soltab_node = T.create_group(solsetout.obj, soltab_name, title=soltype)
+        soltab_node._v_attrs['parmdb_type'] = ''
+        for axis_name, axis_vals in zip(axes_names, axes_vals):
+            T.create_array(soltab_node, axis_name, obj=array(axis_vals))
+
+        dir_axis = axes_names.index('dir')
+        step = self.directions_per_block(shape, dir_axis)
+        for name in ['val', 'weight']:
+            earray = self.solution_array(T, soltab_node, name, shape, axes_names)
+            for start in range(0, shape[dir_axis], step):
+                block = take(values, range(start, min(start + step, shape[dir_axis])), axis=dir_axis)
+                earray.append(block if name == 'val' else ones(block.shape))
+        return self
+
+    def same_polarizations(self, val, axes_names):
+        """
+        Check block by block if the first and last polarization are the same, stops at the first difference
+        :param val: values array
+        :param axes_names: axes names
+        """
+        dir_axis, pol_axis = axes_names.index('dir'), axes_names.index('pol')
+        step = self.directions_per_block(val.shape, dir_axis)
+        for start in range(0, val.shape[dir_axis], step):
+            slicer = [slice(None)] * len(val.shape)
+            slicer[dir_axis] = slice(start, start + step)
+            slicer[pol_axis] = 0
+            first = val[tuple(slicer)]
+            slicer[pol_axis] = val.shape[pol_axis] - 1
+            if not array_equal(first, val[tuple(slicer)], equal_nan=True):
+                return False
+        return True
+
+    def post_process(self, add_directions=None, single_pol=False):
+        """
+        Add default directions (phase all zeros, amplitude all ones) and/or reduce the phase and amplitude tables
+        to a single polarization if both polarizations are the same, in one pass over the output h5 table.
+        New directions are appended to the val/weight arrays along the dir axis, the arrays are only
+        rewritten (block by block) to reduce the polarization axis.
+        :param add_directions: list with directions (coordinates)
+        :param single_pol: return only a single polarization axis if both polarizations are the same
+        """
+        if add_directions and type(add_directions[0]) != list:
+            add_directions = [add_directions]
+        n_add = len(add_directions) if add_directions else 0
+
+        T = tables.open_file(self.file, 'r+')
+        for solset in T.root._f_iter_nodes('Group'):
+            if n_add > 0:
+                # all sources are renamed to Dir00..DirNN, the same names are used for the dir axis of every soltab
+                n_sources = solset.source.nrows
+                dir_names = [bytes('Dir' + str(n).zfill(2), 'utf-8') for n in range(n_sources + n_add)]
+                if n_sources > 0:
+                    solset.source.modify_column(column=dir_names[:n_sources], colname='name')
+                solset.source.append([(dir_name, list(ns)) for dir_name, ns in zip(dir_names[n_sources:], add_directions)])
+            for soltab in solset._f_iter_nodes('Group'):
+                if 'val' not in soltab:
+                    continue
+                axes_names = soltab.val.attrs['AXES'].decode().split(',')
+                dir_axis = axes_names.index('dir')
+                soltype = soltab._v_title
+
+                reduce_pol = False
+                if single_pol and soltype in ['phase', 'amplitude'] and 'pol' in axes_names:
+                    if self.same_polarizations(soltab.val, axes_names):
+                        print('{soltype} has same values for XX and YY polarization.\nReducing into one Polarization I.'
+                              .format(soltype=soltype.capitalize()))
+                        reduce_pol = True
+                    else:
+                        print('ERROR: {soltype} has not the same values for XX and YY polarization.\n'
+                              'ERROR: No polarization reduction will be done.'.format(soltype=soltype.capitalize()))
+                if n_add == 0 and not reduce_pol:
+                    continue
+
+                old_shape = soltab.val.shape
+                for name in ['val', 'weight']:
+                    values = soltab._f_get_child(name)
+                    extendable = isinstance(values, tables.EArray) and values.extdim == dir_axis
+                    if reduce_pol or not extendable:  # rewrite into an extendable array
+                        new_shape = list(values.shape)
+                        slicer = [slice(None)] * len(new_shape)
+                        if reduce_pol:
+                            new_shape[axes_names.index('pol')] = 1
+                            slicer[axes_names.index('pol')] = slice(0, 1)
+                        new_values = self.solution_array(T, soltab, name + '_new', new_shape, axes_names)
+                        step = self.directions_per_block(values.shape, dir_axis)
+                        for start in range(0, values.shape[dir_axis], step):
+                            slicer[dir_axis] = slice(start, start + step)
+                            new_values.append(values[tuple(slicer)])
+                        values._f_remove()
+                        new_values._f_rename(name)
+                        values = new_values
+                    if n_add > 0:
+                        default_shape = list(values.shape)
+                        default_shape[dir_axis] = n_add
+                        if name == 'val' and soltype == 'amplitude':
+                            values.append(ones(default_shape))
+                        elif name == 'val':
+                            values.append(zeros(default_shape))
+                        else:
+                            values.append(ones(default_shape))
+
+                if reduce_pol:
+                    soltab.pol._f_remove()
+                    T.create_array(soltab, 'pol', array([b'I'], dtype='|S2'))
+                if n_add > 0:
+                    if soltab.val.shape[dir_axis] != len(dir_names):
+                        T.close()
+                        raise ValueError('{solset}/{soltab} has {n_dir} directions after adding the default directions, '
+                                         'but the source table has {n_sources}'.format(
+                                          solset=solset._v_name, soltab=soltab._v_name, n_dir=soltab.val.shape[dir_axis],
+                                          n_sources=len(dir_names)))
+                    soltab.dir._f_remove()
+                    T.create_array(soltab, 'dir', array(dir_names))
+                    print('Default directions added for ' + solset._v_name + '/' + soltab._v_name)
+                print('Shape change: ' + str(old_shape) + ' ---> ' + str(soltab.val.shape))
+        T.close()
+        return self
+
     def add_directions(self, add_directions=None):
         """
         Add default directions (phase all zeros, amplitude all ones)
@@ -819,102 +1053,13 @@ class MergeH5:
         """
         if not add_directions:
             return self
-
-        h5 = h5parm(self.file, readonly=True)
-        filetemp = self.file.replace('.h5','')+'temp.h5'
-        h5_temp = h5parm(filetemp, readonly=False)
-        for ss in h5.getSolsetNames():
-            solset = h5.getSolset(ss)
-            solsettemp = h5_temp.makeSolset(ss)
-            if type(add_directions[0])==list:
-                sources = list([source[1] for source in solset.obj.source[:]]) + add_directions
-            else:
-                sources = list([source[1] for source in solset.obj.source[:]]) + [add_directions]
-            sources = [(bytes('Dir' + str(n).zfill(2), 'utf-8'), list(ns)) for n, ns in enumerate(sources)]
-            if len(sources) > 0:
-                solsettemp.obj.source.append(sources)
-
-            for st in h5.getSolset(ss).getSoltabNames():
-                solutiontable = h5.getSolset(ss).getSoltab(st)
-                axes = solutiontable.getValues()[1]
-                values = solutiontable.getValues()[0]
-                axes['dir'] = [ns[0] for ns in sources]
-                dir_index = solutiontable.getAxesNames().index('dir')
-                new_shape = list(values.shape)
-                last_idx = new_shape[dir_index]
-                new_idx = last_idx+len(add_directions)-1
-                new_shape[dir_index] = new_idx
-
-                if 'phase' in st:
-                    values_new = zeros(tuple(new_shape))
-                elif 'amplitude' in st:
-                    values_new = ones(tuple(new_shape))
-                else:
-                    values_new = zeros(tuple(new_shape))
-
-                if dir_index == 0:
-                    values_new[0:last_idx, ...] = values
-                elif dir_index == 1:
-                    values_new[:, 0:last_idx, ...] = values
-                elif dir_index == 2:
-                    values_new[:, :, 0:last_idx, ...] = values
-                elif dir_index == 3:
-                    values_new[:, :, :, 0:last_idx, ...] = values
-                elif dir_index == 4:
-                    values_new[:, :, :, :, 0:last_idx, ...] = values
-
-                weights = ones(values_new.shape)
-                solsettemp.makeSoltab(remove_numbers(st), axesNames=list(axes.keys()), axesVals=list(axes.values()), vals=values_new,
-                                 weights=weights)
-
-                print('Default directions added for '+ss+'/'+st)
-                print('Shape change: '+str(values.shape)+' ---> '+str(values_new.shape))
-
-        h5.close()
-        h5_temp.close()
-
-        os.system('rm '+self.file +' && mv '+filetemp+' '+self.file)
-
-        return self
+        return self.post_process(add_directions=add_directions)
 
     def make_single_pol(self):
         """
         Reduce table to one single polarization
         """
-        T = tables.open_file(self.file, 'r+')
-        newpol = array([b'I'], dtype='|S2')
-        try:
-            if T.root.sol000.phase000.val[0,0,0,0,0] == T.root.sol000.phase000.val[0,0,0,0,-1] and \
-                T.root.sol000.phase000.val[-1, 0, 0, 0, 0] == T.root.sol000.phase000.val[-1, 0, 0, 0, -1]:
-                print('Phase has same values for XX and YY polarization.\nReducing into one Polarization I.')
-                newphase = T.root.sol000.phase000.val[:, :, :, :, 0:1]
-                T.root.sol000.phase000.val._f_remove()
-                T.root.sol000.phase000.pol._f_remove()
-                T.create_array(T.root.sol000.phase000, 'val', newphase)
-                T.create_array(T.root.sol000.phase000, 'pol', newpol)
-            else:
-                print('ERROR: Phase has not the same values for XX and YY polarization.\nERROR: No polarization reduction will be done.')
-                sys.exit()
-        except:
-            pass
-
-        try:
-            if T.root.sol000.amplitude000.val[0, 0, 0, 0, 0] == T.root.sol000.amplitude000.val[0, 0, 0, 0, -1] and \
-                T.root.sol000.amplitude000.val[-1, 0, 0, 0, 0] == T.root.sol000.amplitude000.val[-1, 0, 0, 0, -1]:
-                print('Amplitude has same values for XX and YY polarization.\nReducing into one Polarization I.')
-                newampl = T.root.sol000.amplitude000.val[:, :, :, :, 0:1]
-                T.root.sol000.amplitude000.val._f_remove()
-                T.root.sol000.amplitude000.pol._f_remove()
-                T.create_array(T.root.sol000.amplitude000, 'val', newampl)
-                T.create_array(T.root.sol000.amplitude000, 'pol', newpol)
-            else:
-                print('ERROR: Amplitude has not the same values for XX and YY polarization.\nERROR: No polarization reduction will be done.')
-                sys.exit()
-        except:
-            pass
-
-        T.close()
-        return self
+        return self.post_process(single_pol=True)
 
 
 def make_h5_name(h5_name):
@@ -923,7 +1068,7 @@ def make_h5_name(h5_name):
     return h5_name
 
 def merge_h5(h5_out=None, h5_tables=None, ms_files=None, h5_time_freq=None, convert_tec=True, merge_all_in_one=False,
-             lin2circ=False, circ2lin=False, add_directions=None, single_pol=None):
+             lin2circ=False, circ2lin=False, add_directions=None, single_pol=None, write_block=1024):
     """
     Main function that uses the class MergeH5 to merge h5 tables.
     :param h5_out (string): h5 table name out
@@ -935,6 +1080,9 @@ def merge_h5(h5_out=None, h5_tables=None, ms_files=None, h5_time_freq=None, conv
     :param lin2circ: boolean for linear to circular conversion
     :param circ2lin: boolean for circular to linear conversion
     :param add_directions: add default directions by giving a list of directions (coordinates)
+    :param single_pol: return only a single polarization axis if both polarizations are the same
+    :param write_block: size in MB of the slices in which the output solution tables are written,
+                        this does not limit the memory of the merge (see the module docstring)
     """
 
     h5_out = make_h5_name(h5_out)
@@ -942,7 +1090,7 @@ def merge_h5(h5_out=None, h5_tables=None, ms_files=None, h5_time_freq=None, conv
     if h5_out.split('/')[-1] in [f.split('/')[-1] for f in glob(h5_out)]:
         os.system('rm {}'.format(h5_out))
     merge = MergeH5(h5_out=h5_out, h5_tables=h5_tables, ms_files=ms_files, convert_tec=convert_tec,
-                    merge_all_in_one=merge_all_in_one, h5_time_freq=h5_time_freq)
+                    merge_all_in_one=merge_all_in_one, h5_time_freq=h5_time_freq, write_block=write_block)
     merge.get_allkeys()
     for ss in merge.all_solsets:
         if not '000' in ss:
@@ -977,12 +1125,17 @@ def merge_h5(h5_out=None, h5_tables=None, ms_files=None, h5_time_freq=None, conv
         # pass
     print('END: h5 solution file(s) merged')
 
-    if add_directions:
-        merge.add_directions(add_directions)
-
     if lin2circ and circ2lin:
         sys.exit('Both polarization conversions are given, please choose 1.')
-    elif lin2circ or circ2lin:
+
+    # add directions and remove the polarization axis if double in one pass,
+    # unless the polarization conversion below still needs both polarizations
+    if single_pol and not (lin2circ or circ2lin):
+        print('Make a single polarization')
+    if add_directions or (single_pol and not (lin2circ or circ2lin)):
+        merge.post_process(add_directions=add_directions, single_pol=single_pol and not (lin2circ or circ2lin))
+
+    if lin2circ or circ2lin:
         print("THIS FUNCTION HASN'T BEEN TESTED YET! PLEASE PROVIDE FEEDBACK IF ANY STRANGE RESULT OCCURS.")
         try:
             from supporting_scripts.h5_lin2circ import PolChange
@@ -1018,10 +1171,50 @@ def merge_h5(h5_out=None, h5_tables=None, ms_files=None, h5_time_freq=None, conv
         merge.reduce_memory_source()
 
     #remove polarization axis if double
-    if single_pol:
+    if single_pol and (lin2circ or circ2lin):
         print('Make a single polarization')
         merge.make_single_pol()
 
+def _merge_job(job, **kwargs):
+    """
+    Run merge_h5 for a single (h5_out, h5_tables, ms_files) job in a worker process.
+    sys.exit inside merge_h5 is turned into an exception, so the pool does not hang on it.
+    """
+    h5_out, h5_tables, ms_files = job
+    try:
+        merge_h5(h5_out=h5_out, h5_tables=h5_tables, ms_files=ms_files, **kwargs)
+    except SystemExit as e:
+        raise RuntimeError('Merging {h5_out} failed: {e}'.format(h5_out=h5_out, e=e))
+    return h5_out
+
+def merge_h5_jobs(jobs, ncpu=1, **kwargs):
+    """
+    Merge several sets of h5 tables in parallel, for example one merged h5 table per measurement set.
+    The measurement set axes and the h5 source tables are read once here, the forked workers inherit them.
+    :param jobs: list with (h5_out, h5_tables, ms_files) for every merge
+    :param ncpu: number of merges that run at the same time (default is 1), every merge holds its full merged
+                 solutions in memory, so choose this by the available memory rather than the number of cpus
+    :param kwargs: other arguments for merge_h5
+    """
+    jobs = [(h5_out, sorted(glob(h5_tables)) if type(h5_tables) == str else h5_tables, ms_files)
+            for h5_out, h5_tables, ms_files in jobs]
+    for h5_out, h5_tables, ms_files in jobs:
+        if not kwargs.get('h5_time_freq') and ms_files:
+            ms = glob(ms_files) if type(ms_files) == str else ms_files
+            if len(ms) > 0:
+                read_ms_axes(ms[0])
+        for h5_name in h5_tables:
+            h5 = h5parm(h5_name)
+            for solset in h5.getSolsetNames():
+                read_sources(h5_name, solset, h5.getSolset(solset))
+            h5.close()
+
+    ncpu = max(1, min(ncpu, len(jobs)))
+    if ncpu == 1:
+        return [_merge_job(job, **kwargs) for job in jobs]
+    with mp.get_context('fork').Pool(ncpu) as pool:
+        return pool.map(partial(_merge_job, **kwargs), jobs)
+
 
 
 if __name__ == '__main__':
@@ -1047,6 +1240,11 @@ if __name__ == '__main__':
     parser.add_argument('--circ2lin', action='store_true', help='transform circular polarization to linear')
     parser.add_argument('--add_direction', default=None, help='add direction with amplitude 1 and phase 0 [ex: --add_direction [0.73,0.12]')
     parser.add_argument('--single_pol', action='store_true', default=None, help='Return only a single polarization axis if both polarizations are the same.')
+    parser.add_argument('--numbers', type=str, nargs='+', default=None, help='Do a merge for every number, {n} in -out, -in and -ms is replaced by the number '
+                                                                           '[ex: -out merged.{n}.h5 -in "*.{n}.h5" -ms Dir0.{n}.ms --numbers 0 1 2]')
+    parser.add_argument('--ncpu', type=int, default=1, help='Number of merges that run in parallel with --numbers, every merge holds its full merged solutions in memory (default is 1)')
+    parser.add_argument('--write_block', type=float, default=1024, help='Size in MB of the slices in which the output solution tables are written (default is 1024). '
+                                                                        'This is not a memory limit, the merged solutions are held in memory in full')
 
     args = parser.parse_args()
 
@@ -1067,13 +1265,29 @@ if __name__ == '__main__':
         add_directions = None
 
 
-    merge_h5(h5_out=args.h5_out,
-             h5_tables=h5tables,
-             ms_files=args.ms_time_freq,
-             h5_time_freq=args.h5_time_freq,
-             convert_tec=args.convert_tec,
-             merge_all_in_one=args.merge_all_in_one,
-             lin2circ=args.lin2circ,
-             circ2lin=args.circ2lin,
-             add_directions=add_directions,
-             single_pol=args.single_pol)
\ No newline at end of file
+    if args.numbers:
+        jobs = [(args.h5_out.format(n=n),
+                 sorted([h5 for h5_table in h5tables for h5 in glob(h5_table.format(n=n))]),
+                 args.ms_time_freq.format(n=n) if args.ms_time_freq else None) for n in args.numbers]
+        merge_h5_jobs(jobs,
+                      ncpu=args.ncpu,
+                      h5_time_freq=args.h5_time_freq,
+                      convert_tec=args.convert_tec,
+                      merge_all_in_one=args.merge_all_in_one,
+                      lin2circ=args.lin2circ,
+                      circ2lin=args.circ2lin,
+                      add_directions=add_directions,
+                      single_pol=args.single_pol,
+                      write_block=args.write_block)
+    else:
+        merge_h5(h5_out=args.h5_out,
+                 h5_tables=h5tables,
+                 ms_files=args.ms_time_freq,
+                 h5_time_freq=args.h5_time_freq,
+                 convert_tec=args.convert_tec,
+                 merge_all_in_one=args.merge_all_in_one,
+                 lin2circ=args.lin2circ,
+                 circ2lin=args.circ2lin,
+                 add_directions=add_directions,
+                 single_pol=args.single_pol,
+                 write_block=args.write_block)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from astropy import units as u
 import copy
+import hashlib
 import os
 import gc
 import glob
@@ -9,6 +10,7 @@ from losoto.lib_operations import reorderAxes
 from matplotlib.pyplot import figure, show
 from scipy import ndimage
 from scipy.interpolate import Rbf
+from scipy.linalg import solve
 from scipy.signal import medfilt
 import matplotlib.pyplot as plt
 import argparse
@@ -20,6 +22,8 @@ from astropy.coordinates import Angle
 import sys
 import scipy.ndimage as ndimage
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from screen_io import screen_blocks, create_fits_on_disk, fits_on_disk_matches, write_fits_screen, create_h5_screen, open_h5_screen, write_h5_screen, load_screen_cache, save_screen_cache
 
 
 def plot_screen(img, prefix='', title='', suffix='', wcs=None):
@@ -39,6 +43,27 @@ def plot_screen(img, prefix='', title='', suffix='', wcs=None):
     plt.close(fig)
     del fig
 
+def to_shared_memory(arr):
+    '''
+        Copy an array into a multiprocessing.shared_memory block and return a read-only view of it
+        The block is kept in shared_blocks until release_shared_memory, the pool workers inherit
+        the mapping, so reading from it never duplicates pages
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    shared.flags.writeable = False
+    shared_blocks.append(shm)
+    return shared
+
+def release_shared_memory():
+    for shm in shared_blocks:
+        shm.close()
+        shm.unlink()
+    del shared_blocks[:]
+
+shared_blocks = []
+
 def phaseref(phase, refstation = 0):
    print('Using reference station', refstation) 
    phasetmp =  np.copy(phase[:,:,refstation,:,:])
@@ -60,8 +85,11 @@ parser.add_argument('--FITSscreen', help='Output FITS screen file', type=str, de
 parser.add_argument('--freqdownsamplefactor', help='Downsample freq axis with this factor, needs to be a multiple on the input freq length', type=int, default=None)
 parser.add_argument('--plotsfortesting', help='Show plots for testing. Requires an argument equal to the station that you want to show. Also, will be ignored if ncpu!=1.', default=None,type=str)
 parser.add_argument('--ms', help='Measurement set to be imaged with IDG, phasecenter location is taken from the ms', type=str,required=True)
-parser.add_argument('--ncpu', help='Amount of subprocesses that are to be spawned for computation of gainscreens. This is a memory limited step, and non-unity values of ncpu might slow down this process!', type=int, default=1)
+parser.add_argument('--ncpu', help='Amount of subprocesses that are to be spawned for computation of gainscreens. The gains and interpolation operators are shared between the subprocesses, so memory use does not grow with ncpu', type=int, default=1)
 parser.add_argument('--timeblocks', help='Break up the final gainscreen in timeblocks, which will decrease the memory footprint',default=1,type=int)
+parser.add_argument('--skipnodalcheck', help='Skip the check that the interpolated screens go through the nodal points (faster)', action='store_true')
+parser.add_argument('--incremental', help='Reuse the output of a previous run with the same output name and settings, only the (station, freq, timeblock) parts whose input gains changed are recomputed', action='store_true')
+parser.add_argument('--outputformat', help='Write the screen as FITS, or as a compressed HDF5 file (chunked per timeblock) that can be converted to FITS with screen_io.py, default=fits', default='fits', choices=['fits', 'hdf5'], type=str)
 
 
 
@@ -279,6 +307,7 @@ for d in directions:
 
 RA = np.asarray(RA)
 DEC = np.asarray(DEC)
+Xdir, Ydir = np.around(wcs.wcs_world2pix(RA, DEC, 0)).astype(int)
 # Interpolate the grid using a nearest neighbour approach.
 # https://stackoverflow.com/questions/5551286/filling-gaps-in-a-numpy-array
 
@@ -378,8 +407,110 @@ def plotScreens(data_int,station,ifreq,antenna,h5_stations,xxwcs,yywcs, RA_X,DEC
     plt.savefig(f'plots/{station}_{ifreqtosave}.png')
 
 
+def padded_nodes(X, Y, padding=False):
+    '''
+        Return the node positions used for the RBF interpolation. With padding, extra nodes
+        with gain 1 are placed every stepsizepadding pixels along the screen edges
+        (bottom, top, left, right), in the same order as the padded gain vector.
+    '''
+    if not padding:
+        return np.asarray(X), np.asarray(Y), 0
+    pp = np.arange(0, size, args['stepsizepadding'])
+    edge0 = np.zeros_like(pp)
+    edge1 = np.full_like(pp, size-1)
+    Xpad = np.concatenate([np.column_stack([pp, pp]).ravel(), np.column_stack([edge0, edge1]).ravel()])
+    Ypad = np.concatenate([np.column_stack([edge0, edge1]).ravel(), np.column_stack([pp, pp]).ravel()])
+    return np.append(X, Xpad), np.append(Y, Ypad), len(Xpad)
+
+def rbf_screen_operator(X, Y, size, smooth=1e-8):
+    '''
+        Precompute the (size*size, Nnodes) matrix that maps the node values onto the screen.
+        This reproduces scipy.interpolate.Rbf (multiquadric kernel, default epsilon), but the
+        kernel matrix only depends on the node positions, so it is factorized once and every
+        timeslot becomes a single matrix product.
+    '''
+    xi = np.asarray([np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64)])
+    N = xi.shape[-1]
+    # default epsilon of Rbf: average distance between nodes based on the bounding box
+    edges = np.amax(xi, axis=1) - np.amin(xi, axis=1)
+    edges = edges[np.nonzero(edges)]
+    epsilon = np.power(np.prod(edges)/N, 1.0/edges.size)
+
+    r = np.hypot(xi[0][:,None] - xi[0][None,:], xi[1][:,None] - xi[1][None,:])
+    A = np.sqrt((r/epsilon)**2 + 1) - np.eye(N)*smooth
+
+    xx, yy = np.meshgrid(np.arange(size), np.arange(size))
+    rgrid = np.hypot(xx.ravel()[:,None] - xi[0][None,:], yy.ravel()[:,None] - xi[1][None,:])
+    phigrid = np.sqrt((rgrid/epsilon)**2 + 1)
+    del rgrid
+    # screen = phigrid . A^-1 . g, and A is symmetric
+    # solve raises a LinAlgError for a singular kernel matrix, like Rbf does, instead of returning inf/NaN
+    operator = solve(A, phigrid.T).T
+    if not np.isfinite(operator).all():
+        raise np.linalg.LinAlgError('The RBF kernel matrix of the {:d} screen nodes is singular, '
+                                    'check for directions on the same pixel'.format(N))
+    return operator
+
+_screen_operators = {}
+def get_screen_operator(X, Y, padding=False, smooth=1e-8):
+    '''
+        Cached rbf_screen_operator, the direction positions do not change during a run
+    '''
+    key = (padding, smooth)
+    if key not in _screen_operators:
+        _screen_operators[key] = rbf_screen_operator(X, Y, size, smooth=smooth)
+    return _screen_operators[key]
+
+def pad_gains(g, npad=0):
+    '''
+        Append the padding nodes (amplitude=1, phase=0) to the gains with shape (time, dir)
+    '''
+    if npad == 0:
+        return g
+    return np.concatenate([g, np.ones((g.shape[0], npad), dtype=g.dtype)], axis=1)
+
+def interpolate_gains(operator, g, npad=0):
+    '''
+        Evaluate the screens for all timeslots at once, g has shape (time, dir)
+        Returns an array with shape (time, size, size)
+    '''
+    g = pad_gains(g, npad)
+    return np.dot(g, operator.T).reshape(g.shape[0], size, size)
+
+def check_nodal_points(tinterp, gcom, Xcom, Ycom, pol):
+    '''
+        Check for all timeslots at once that the screens (time, size, size) go through the nodal points gcom (time, dir)
+    '''
+    good = np.isclose(tinterp[:, Ycom, Xcom], gcom, rtol=1e-1, atol=1e-1).all(axis=1)
+    if not good.all():
+        print('Interpolated screen for polarization {:s} does not go through nodal points for {:d} of {:d} timeslots.'.format(pol, np.sum(~good), len(good)))
+
+def interpolation_index(antname):
+    '''
+        Index of the h5 station whose solutions are used for antname
+    '''
+    if ('CS' in antname) and ('ST001' in h5_stations):
+        # Take ST001 solutions.
+        return h5_stations.index('ST001')
+    return h5_stations.index(antname)
+
+def station_groups(ifreq):
+    '''
+        Group the stations that have identical input gains (and positions) for this frequency slot,
+        e.g. all core stations when they take the ST001 solutions. Their screens are identical,
+        so each group only has to be interpolated once.
+    '''
+    groups = {}
+    for station in names:
+        key = hashlib.sha1()
+        key.update(np.ascontiguousarray(gains[:Ntimes, ifreq, interpolation_index(station), :, :]).tobytes())
+        key.update(np.ascontiguousarray(Xdir).tobytes())
+        key.update(np.ascontiguousarray(Ydir).tobytes())
+        groups.setdefault(key.hexdigest(), []).append(station)
+    return list(groups.values())
+
 #def interpolate_station(antidx, interpidx, x_from, y_from, tecs, x_to, y_to):
-def interpolate_station(antname,ifstep, ntimes, padding=False, includeamps=True, scalarpol=False, smoothamps=False):
+def interpolate_station(antname,ifstep, ntimes, padding=False, includeamps=True, scalarpol=False, smoothamps=False, nodalcheck=True, tstart=0):
     '''
         This function is the 'main' function, doing the heavy lifting
         maybe we need to add a show_plot functionality in here somewhere? Maybe not?
@@ -390,23 +521,14 @@ def interpolate_station(antname,ifstep, ntimes, padding=False, includeamps=True,
       refidx = h5_stations.index('ST001')
     else:
       refidx = 0  
-    if ('CS' in antname) and ('ST001' in h5_stations):
-        # Take ST001 solutions.
-        interpidx = h5_stations.index('ST001')
-    else:
-        interpidx = h5_stations.index(antname)
+    interpidx = interpolation_index(antname)
     # These will be the new coordinates to evaluate the screen over.
     ra_max, ra_min = wcs.wcs_pix2world(0, 0, 0)[0], wcs.wcs_pix2world(size-1, size-1, 0)[0]
     dec_min, dec_max = wcs.wcs_pix2world(0, 0, 0)[1], wcs.wcs_pix2world(size-1, size-1, 0)[1]
 
-    x = np.arange(size)
-    y = np.arange(size)
-    xx, yy = np.meshgrid(x, y)
-
-  
     # Do radial basis function interpolation for each time step.
     screen = np.ones((ntimes, 1, 1, 4, size, size), dtype=np.float32)
-    X, Y = np.around(wcs.wcs_world2pix(RA, DEC, 0)).astype(int)
+    X, Y = Xdir, Ydir
 
     #X, Y = wcs.wcs_world2pix(RA, DEC, 0)
     
@@ -428,359 +550,187 @@ def interpolate_station(antname,ifstep, ntimes, padding=False, includeamps=True,
     #print(screen.shape)
     # data has shape (time, freq, ant, matrix, y, x)
     # gains has shape (time, freq, ant, dir, pol)
-    # Iterate over all timeslots.
-    for itstep in range(ntimes):
-        # Interpolate the gains, not the Re/Im or Amp/Phase separately.
-        gXX = gains[itstep, ifstep, interpidx, :, 0]
-        gYY = gains[itstep, ifstep, interpidx, :, -1]
-        
-        
-        #skip_because_samegain = False
-        #try:
-        #  if np.array_equal(gains[itstep, ifstep, interpidx, :, :], gains[itstep, ifstep, interpidx-1, :, :]):
-        #     skip_because_samegain = True
-        #except:
-        #  pass  
-        #if skip_because_samegain:
-        #   return names.index(antname), screen, [0, size-1], [0, size-1], gXXcom, gYYcom, Xcom, Ycom    
-             
-             
-        if padding: 
-            # for bottom X-axis and top X-axis
-            for pp in np.arange(0,size,args['stepsizepadding']):
-              # bottom
-              if itstep == 0:  #otherwise the X, Y arrays keep growing!!
-                X = np.append(X,pp)
-                Y = np.append(Y,0)
-              gXX = np.append(gXX,1.0+1j*0.)
-              gYY = np.append(gYY,1.0+1j*0.)
-              # top
-              if itstep == 0:  #otherwise the X, Y arrays keep growing!!
-                X = np.append(X,pp)
-                Y = np.append(Y,np.int(size)-1)
-              gXX = np.append(gXX, 1.0+1j*0.)
-              gYY = np.append(gYY, 1.0+1j*0.)
-            # for left Y-axis and right Y-axis
-            for pp in np.arange(0,size,args['stepsizepadding']):
-              # left
-              if itstep == 0:  #otherwise the X, Y arrays keep growing!!
-                Y = np.append(Y,pp)
-                X = np.append(X,0)
-              gXX = np.append(gXX,1.0+1j*0.)
-              gYY = np.append(gYY,1.0+1j*0.)
-              # right
-              if itstep == 0:  #otherwise the X, Y arrays keep growing!!
-                Y = np.append(Y,pp)
-                X = np.append(X,np.int(size)-1)
-              gXX = np.append(gXX,1.0+1j*0.)
-              gYY = np.append(gYY,1.0+1j*0.)
-        
-        
-        rbfXX = Rbf(X, Y, gXX, smooth=1e-8)
-        if scalarpol:
-          rbfYY = rbfXX
-        else:
-          rbfYY = Rbf(X, Y, gYY, smooth=1e-8)  
-
-        if smoothamps:
-           #rbfXXphase = Rbf(X, Y, np.exp(1j*np.angle(gXX)), smooth=1e-8)
-           rbfXXphase = Rbf(X, Y, gXX, smooth=1e-8) # do include amps here, makes the phases smoother at the end
-           if scalarpol:
-             rbfYYphase = rbfXXphase
-           else:
-             #rbfYYphase = Rbf(X, Y, np.exp(1j*np.angle(gYY)), smooth=1e-8)  
-             rbfYYphase = Rbf(X, Y, gYY, smooth=1e-8) # do include amps here, makes the phases smoother at the end
-
-
-           rbfXXamp = Rbf(X, Y, np.abs(gXX)*np.exp(1j*0.0), smooth=1e-2)
-           if scalarpol:
-             rbfYYamp = rbfXXamp
-           else:
-             rbfYYamp = Rbf(X, Y, np.abs(gYY)*np.exp(1j*0.0), smooth=1e-2)  
-
-           tinterpXX = np.abs(rbfXXamp(xx, yy))*np.exp(1j*np.angle(rbfXXphase(xx, yy)))   
-           if scalarpol:
-             tinterpYY = tinterpXX
-           else:
-             tinterpYY = np.abs(rbfYYamp(xx, yy))*np.exp(1j*np.angle(rbfYYphase(xx, yy)))   
-        else: 
-           tinterpXX = rbfXX(xx, yy)
-           if scalarpol:
-             tinterpYY = tinterpXX
-           else:
-             tinterpYY = rbfYY(xx, yy)
-        
-        
-        if not includeamps:
-          # reset amps to 1.0  
-          tinterpXX = np.exp(1j *np.angle(tinterpXX))
-          if scalarpol:
-            tinterpYY = tinterpXX  
-          else:
-            tinterpYY = np.exp(1j *np.angle(tinterpYY))
-        
-        #print ph.shape
-        #print np.mean(ph), 'beg mean'
-        
-        #ph = ndimage.gaussian_filter(ph, sigma=(7, 7))
-        #print np.mean(ph), 'end mean'
-        #print ph.shape
-        #sys.exit()
-        #ap = np.abs(tinterpXX)
-        #tinterpXX = np.exp(1j * ph)
-        #tinterpYY = tinterpXX
-
-        #data[t, f, s, 0, ind[0], ind[1]] = 1. * np.cos(pb)
-        #data[t, f, s, 2, ind[0], ind[1]] = val_amp_yy * np.cos(pb)
-        #data[t, f, s, 1, ind[0], ind[1]] = val_amp_xx * np.sin(pb)
-        #data[t, f, s, 3, ind[0], ind[1]] = val_amp_yy * np.sin(pb)
-        #print(tinterpXX.shape)
-        #print(tinterpYY.shape)
-        #print(Y.shape, X.shape, gXX.shape, gYY.shape)
-
-        # remove directions outside screen area for the allclose comparison below
-        Xcom=[]
-        Ycom=[]
-        gXXcom = []
-        gYYcom = []
-        #print(X)
-        #sys.exit()
-        for ddd in range(len(X)):
-          if not (X[ddd] > (np.float(size)-1.) or X[ddd]< 0.0 or Y[ddd] > (np.float(size)-1.) or Y[ddd] < 0.0): # outside screen
-            #print X[ddd], Y[ddd]
-            Xcom = np.append(Xcom,X[ddd])
-            Ycom = np.append(Ycom,Y[ddd])
-            gXXcom = np.append(gXXcom,gXX[ddd])  
-            gYYcom = np.append(gYYcom,gYY[ddd]) 
-            
-      
-        if not np.allclose(tinterpXX[Ycom.astype(int),Xcom.astype(int)], gXXcom, rtol=1e-1, atol=1e-1):
-            #print(itstep, ifstep, interpidx)
-            #print('gXXcom', gXXcom)
-            #print('tinterpXX', tinterpXX[Ycom.astype(int),Xcom.astype(int)])
-            #print('diff', gXXcom - tinterpXX[Ycom.astype(int),Xcom.astype(int)])
-            print('Interpolated screen for polarization XX does not go through nodal points.')
-            #raise ValueError('Interpolated screen for polarization XX does not go through nodal points.')
-        
-        if not scalarpol:
-          if not np.allclose(tinterpYY[Ycom.astype(int),Xcom.astype(int)], gYYcom, rtol=1e-1, atol=1e-1):
-             #raise ValueError('Interpolated screen for polarization YY does not go through nodal points.')
-             print('Interpolated screen for polarization YY does not go through nodal points.')   
-        
-        del gXX, gYY #, Ycom, Xcom #, gXXcom, gYYcom # free up RAM
-        matrix = np.asarray([np.real(tinterpXX), np.imag(tinterpXX), np.real(tinterpYY), np.imag(tinterpYY)])
-        del tinterpXX, tinterpYY
-        
-        screen[itstep, 0, 0, :, :, :] = matrix
-
-    #print( [ra_min, ra_max], [dec_min, dec_max])
-    return names.index(antname), screen, [0, size-1], [0, size-1], gXXcom, gYYcom, Xcom, Ycom
-    #return names.index(antname), screen, [ra_min, ra_max], [dec_min, dec_max], gXXcom, gYYcom
-
-
-def single_writerun(ifreq):
-    print('Processing frequency slot {:d}'.format(ifreq))
-    data_int = np.ones((Ntimes+1,Nantenna,4,size,size),dtype=np.float32)
-    tupples = [(station, ifreq, Ntimes, args['padding'], includeamps, scalarpol) for station in names]
-    for station in names:
-        antenna, screen, xxwcs, yywcs, gXXcom, gYYcom, RA_X, DEC_Y = interpolate_station(station, ifreq, Ntimes, padding=args['padding'], includeamps=includeamps, scalarpol=scalarpol)
-        #print('Screen: ', screen.shape)
-        #print('data_int: ', data_int.shape)
-        data_int[:-1, antenna, :, :, :] = screen[:, 0, 0, :, :, :]
-        data_int[-1, antenna, :, :, :] = screen[-1, 0, 0, :, :, :]
-        if args['plotsfortesting'] == station:
-            print('PLOTTING')
-            plotScreens(data_int[:,np.newaxis,:,:,:,:],station,ifreq,antenna,h5_stations,xxwcs,yywcs,RA_X,DEC_Y)
-    hdu = fits.PrimaryHDU()
-    hdu.data = data_int
-    hdu.writeto('partfits_{}.fits'.format(ifreq),overwrite=True)
-    del data_int
-    del hdu.data
-    del hdu
-    gc.collect()
+    X, Y, npad = padded_nodes(X, Y, padding=padding)
+    operator = get_screen_operator(X, Y, padding=padding, smooth=1e-8)
 
-# Inspired by https://stackoverflow.com/questions/38309535/populate-numpy-array-through-concurrent-futures-multiprocessing
-#print('Shape of the output SCREEN:',data.shape)
+    # Interpolate the gains, not the Re/Im or Amp/Phase separately.
+    gXXall = gains[tstart:tstart+ntimes, ifstep, interpidx, :, 0]
+    gYYall = gains[tstart:tstart+ntimes, ifstep, interpidx, :, -1]
 
+    tinterpXXall = interpolate_gains(operator, gXXall, npad)
+    if scalarpol:
+      tinterpYYall = tinterpXXall
+    else:
+      tinterpYYall = interpolate_gains(operator, gYYall, npad)
+
+    if smoothamps:
+       # phases: include amps here, makes the phases smoother at the end
+       operator_amp = get_screen_operator(X, Y, padding=padding, smooth=1e-2)
+       tinterpXXall = np.abs(interpolate_gains(operator_amp, np.abs(gXXall), npad))*np.exp(1j*np.angle(tinterpXXall))
+       if scalarpol:
+         tinterpYYall = tinterpXXall
+       else:
+         tinterpYYall = np.abs(interpolate_gains(operator_amp, np.abs(gYYall), npad))*np.exp(1j*np.angle(tinterpYYall))
+
+    if not includeamps:
+      # reset amps to 1.0  
+      tinterpXXall = np.exp(1j *np.angle(tinterpXXall))
+      if scalarpol:
+        tinterpYYall = tinterpXXall  
+      else:
+        tinterpYYall = np.exp(1j *np.angle(tinterpYYall))
+
+    # directions inside the screen area, only these are used for the nodal point check
+    inscreen = (X >= 0) & (X <= size-1) & (Y >= 0) & (Y <= size-1)
+    Xcom, Ycom = X[inscreen], Y[inscreen]
+    gXXcom = pad_gains(gXXall, npad)[:, inscreen]
+    gYYcom = pad_gains(gYYall, npad)[:, inscreen]
+    if nodalcheck:
+        check_nodal_points(tinterpXXall, gXXcom, Xcom, Ycom, 'XX')
+        if not scalarpol:
+            check_nodal_points(tinterpYYall, gYYcom, Xcom, Ycom, 'YY')
 
-#
-#data_int = np.ones(data.shape, dtype=np.float32)
-# data_int = np.ones((Ntimes+1, Nfreqs, Nantenna, 4, size, size), dtype=np.float32)
-
-ncpu = args['ncpu']
-
-if ncpu >1:
-    # Pool the single runs. Afterwards, concatenate.
-    pl = mp.Pool(ncpu)
-    pl.map(single_writerun,np.arange(Nfreqs))
-
-    dims = H['NAXIS']
-    shape = []
+    screen[:, 0, 0, 0, :, :] = np.real(tinterpXXall)
+    screen[:, 0, 0, 1, :, :] = np.imag(tinterpXXall)
+    screen[:, 0, 0, 2, :, :] = np.real(tinterpYYall)
+    screen[:, 0, 0, 3, :, :] = np.imag(tinterpYYall)
+    del tinterpXXall, tinterpYYall
 
-    for i in range(dims):
-        shape.append(H[f'NAXIS{i+1}'])
+    #print( [ra_min, ra_max], [dec_min, dec_max])
+    return names.index(antname), screen, [0, size-1], [0, size-1], gXXcom[-1], gYYcom[-1], Xcom, Ycom
+    #return names.index(antname), screen, [ra_min, ra_max], [dec_min, dec_max], gXXcom, gYYcom
 
-    shape = tuple(shape[::-1]) # Byte order is inverted for fits files 
 
-    # Prepare all the headers
+def compute_workunit(task):
+    '''
+        Compute the screen for one (frequency slot, station group, time range) work unit
+        All stations in the group share the same input gains, so the screen is interpolated only once
+        Returns ifreq, the antenna indices of the group, the screen with shape (time, matrix, y, x) and its first timeslot
+    '''
+    ifreq, stations, t0, t1 = task
+    # the output has one extra time slice at the end (a copy of the last one), see the header
+    tfirst, tstop = min(t0, Ntimes-1), min(t1, Ntimes)
+    antenna, screen, xxwcs, yywcs, gXXcom, gYYcom, RA_X, DEC_Y = interpolate_station(stations[0], ifreq, tstop-tfirst, padding=args['padding'], includeamps=includeamps, scalarpol=scalarpol, nodalcheck=not args['skipnodalcheck'], tstart=tfirst)
+    if len(stations) > 1:
+        print('Reusing the screen of', stations[0], 'for', ', '.join(stations[1:]))
+    data_station = screen[:, 0, 0, :, :, :]
+    if t1 == Ntimes+1:
+        data_station = np.concatenate([data_station, screen[-1:, 0, 0, :, :, :]])
+    data_station = data_station[t0-tfirst:]
+    del screen
+    if args['plotsfortesting'] in stations and t0 == 0 and t1 == Ntimes+1:
+        print('PLOTTING')
+        plotScreens(data_station[:,np.newaxis,np.newaxis,:,:,:],args['plotsfortesting'],ifreq,0,h5_stations,xxwcs,yywcs,RA_X,DEC_Y)
+    return ifreq, [names.index(station) for station in stations], data_station, t0
+
+def single_writerun(task):
+    '''
+        Compute one work unit and write it straight into the preallocated FITS file(s)
+    '''
+    write_fits_screen(blocks, *compute_workunit(task))
 
+def screen_settings():
+    '''
+        Hash of everything except the gains that determines the screen, a previous output is only reused when this matches
+    '''
+    key = hashlib.sha1(header.encode('ascii'))
+    for setting in ['size', 'boxwidth', 'includeamps', 'smoothamps', 'padding', 'stepsizepadding', 'freqdownsamplefactor', 'timeblocks', 'outputformat']:
+        key.update(repr(args[setting]).encode('ascii'))
+    # direction set
+    key.update(np.ascontiguousarray(RA).tobytes())
+    key.update(np.ascontiguousarray(DEC).tobytes())
+    return key.hexdigest()
+
+def unit_hash(ifreq, station, start, numtimesteps):
+    '''
+        Hash of the input gains of one (freq, station, time block) part of the screen
+    '''
+    # the extra time slice at the end is a copy of the last solution time
+    tfirst, tstop = min(start, Ntimes-1), min(start+numtimesteps, Ntimes)
+    return hashlib.sha1(np.ascontiguousarray(gains[tfirst:tstop, ifreq, interpolation_index(station), :, :]).tobytes()).hexdigest()
+
+# Put the gains and the interpolation operators in shared memory once, the subprocesses read them from there
+# The shared memory blocks are released also when the screen computation fails
+try:
+    gains = to_shared_memory(gains)
+    Xnodes, Ynodes, npad = padded_nodes(Xdir, Ydir, padding=args['padding'])
+    for smooth in ([1e-8, 1e-2] if args['smoothamps'] else [1e-8]):
+        _screen_operators[(args['padding'], smooth)] = to_shared_memory(rbf_screen_operator(Xnodes, Ynodes, size, smooth=smooth))
+
+    ncpu = args['ncpu']
     TIMEBLOCKS = args['timeblocks']
-
-    timesteps_per_block = shape[0]//TIMEBLOCKS
-    startpix = 1
-
-    # Compute the amount of timesteps precisely
-
-    if TIMEBLOCKS != 1:
-        datasizes = []
-        start = 0
-        starts = []
-        for i in range(TIMEBLOCKS-1):
-            datasizes.append(timesteps_per_block)
-            starts.append(start)
-            start+=timesteps_per_block
-        datasizes.append(shape[0] - start) 
-        starts.append(starts[-1]+timesteps_per_block)
-
-        # Construct the headers
-        headers = []
-        for j in range(TIMEBLOCKS):
-            Hloc = copy.deepcopy(H)
-            Hloc['CRVAL6'] += Hloc['CDELT6'] * starts[j]
-            headers.append(Hloc)
-
-
-    if TIMEBLOCKS == 1:
-        # No time averaging
-        data_int = np.zeros(shape,dtype=np.float32)
-        # Resort fitslist
-        fitslist = glob.glob('partfits*')
-        fitsnums = [int(fit.split('_')[1].split('.')[0]) for fit in fitslist]
-        fitsnums = np.sort(np.array(fitsnums))
-        fitslist = [f'partfits_{i}.fits' for i in fitsnums]
-        for j in fitsnums:
-            data_int[:,j,:,:,:,:] = fits.getdata(fitslist[j])
-
-        hdu = fits.PrimaryHDU(header=H)
-        hdu.data = data_int
-        hdu.writeto(fitsfilename)
-
-    else:
-        for timeslot in range(TIMEBLOCKS):
-            # Do this timeslot, one at the time.
-            print('Processing timeslot '+str(timeslot))
-            start = starts[timeslot]
-            numtimesteps = datasizes[timeslot]
-            head = headers[timeslot]
-
-            timeslot_shape = list(shape)
-            timeslot_shape[0] = numtimesteps
-            data_int = np.zeros(tuple(timeslot_shape),dtype=np.float32)
-
-            fitslist = glob.glob('partfits*')
-            fitsnums = [int(fit.split('_')[1].split('.')[0]) for fit in fitslist]
-            fitsnums = np.sort(np.array(fitsnums))
-            fitslist = [f'partfits_{i}.fits' for i in fitsnums]
-            for j in fitsnums:
-                data_int[:,j,:,:,:,:] = fits.getdata(fitslist[j])[start:start+numtimesteps,:,:,:,:]
-
-            hdu = fits.PrimaryHDU(header=head)
-            hdu.data = data_int
-            del data_int
-            hdu.writeto(f'{fitsfilename_prefix}_timeslot{timeslot}.fits')
-            del hdu.data
-            del hdu
-            gc.collect()
-
-    fitslist = glob.glob('partfits*')
-    fitsnums = [int(fit.split('_')[1].split('.')[0]) for fit in fitslist]
-    fitsnums = np.sort(np.array(fitsnums))
-    fitslist = [f'partfits_{i}.fits' for i in fitsnums]
-    print('Removing temporary files...')
-
-    for fit in fitslist:
-        os.system(f'rm -rf {fit}')
-
-if ncpu == 1:
-    data_int = np.ones((Ntimes+1, Nfreqs, Nantenna, 4, size, size), dtype=np.float32)
+    blocks = screen_blocks(H, fitsfilename, TIMEBLOCKS)
+    h5filename = fitsfilename_prefix + '.h5'
+    cachefile = fitsfilename_prefix + '_screencache.json'
+    settings = screen_settings()
+
+    # Reuse the previous output if requested and possible, otherwise preallocate new output
+    cache = {}
+    h5screen = None
+    if args['incremental']:
+        if args['outputformat'] == 'fits':
+            if all([fits_on_disk_matches(filename, head) for filename, head, start, numtimesteps in blocks]):
+                cache = load_screen_cache(cachefile, settings)
+        else:
+            h5screen = open_h5_screen(h5filename, H)
+            if h5screen is not None:
+                cache = load_screen_cache(cachefile, settings)
+    if len(cache) == 0:
+        if os.path.isfile(cachefile):
+            os.remove(cachefile)
+        if args['outputformat'] == 'fits':
+            # Preallocate the output FITS file(s), every work unit writes its own plane into them
+            for filename, head, start, numtimesteps in blocks:
+                create_fits_on_disk(filename, head)
+        else:
+            if h5screen is not None:
+                h5screen.close()
+            h5screen = create_h5_screen(h5filename, H, timeblocks=TIMEBLOCKS)
+
+    # Schedule (freq, station group, time range) work units, so all cores are used also when Nfreqs < ncpu
+    # Stations with identical gains (e.g. core stations using ST001) are grouped into one work unit
+    # Time blocks whose input gains did not change since the previous run are skipped
+    tasks = []
+    units = {}
     for ifreq in range(Nfreqs):
-        print('Processing frequency slot {:d}'.format(ifreq))
-        tupples = [(station, ifreq, Ntimes, args['padding'], includeamps, scalarpol) for station in names]
-        for station in names:
-            antenna, screen, xxwcs, yywcs, gXXcom, gYYcom, RA_X, DEC_Y = interpolate_station(station, ifreq, Ntimes, padding=args['padding'], includeamps=includeamps, scalarpol=scalarpol)
-            #print('Screen: ', screen.shape)
-            #print('data_int: ', data_int.shape)
-            data_int[:-1, ifreq, antenna, :, :, :] = screen[:, 0, 0, :, :, :]
-            data_int[-1, ifreq, antenna, :, :, :] = screen[-1, 0, 0, :, :, :]
-            if station == args['plotsfortesting']:
-                print('PLOTTING')
-                plotScreens(data_int,station,ifreq,antenna,h5_stations,xxwcs,yywcs,RA_X,DEC_Y)
-
-    print(TIMEBLOCKS)
-    if TIMEBLOCKS == 1:
-        hdu = fits.PrimaryHDU(header=H)
-        hdu.data = data_int
-        hdu.writeto(args['FITSscreen'], overwrite=True)
-        print('Finished interpolating.')
+        for stations in station_groups(ifreq):
+            todo = []
+            for iblock, (filename, head, start, numtimesteps) in enumerate(blocks):
+                blockhash = unit_hash(ifreq, stations[0], start, numtimesteps)
+                for station in stations:
+                    unit = '{:d}/{:s}/{:d}'.format(ifreq, station, iblock)
+                    if cache.get(unit) != blockhash and iblock not in todo:
+                        todo.append(iblock)
+                    units[unit] = blockhash
+            if len(todo) > 0:
+                tasks.append((ifreq, stations, blocks[todo[0]][2], blocks[todo[-1]][2] + blocks[todo[-1]][3]))
+    print('Computing {:d} work units'.format(len(tasks)))
+
+    if args['outputformat'] == 'fits':
+        if ncpu > 1:
+            pl = mp.get_context('fork').Pool(ncpu)
+            pl.map(single_writerun, tasks, chunksize=max(1, len(tasks)//(4*ncpu)))
+            pl.close()
+            pl.join()
+        else:
+            for task in tasks:
+                single_writerun(task)
     else:
-        dims = H['NAXIS']
-        shape = []
-
-        for i in range(dims):
-            shape.append(H[f'NAXIS{i+1}'])
-
-        shape = tuple(shape[::-1]) # Byte order is inverted for fits files 
-
-        # Prepare all the headers
-
-        TIMEBLOCKS = args['timeblocks']
-
-        timesteps_per_block = shape[0]//TIMEBLOCKS
-        startpix = 1
-
-        # Compute the amount of timesteps precisely
-
-        datasizes = []
-        start = 0
-        starts = []
-        for i in range(TIMEBLOCKS-1):
-            datasizes.append(timesteps_per_block)
-            starts.append(start)
-            start+=timesteps_per_block
-        datasizes.append(shape[0] - start) 
-        starts.append(starts[-1]+timesteps_per_block)
-
-        # Construct the headers
-        headers = []
-        for j in range(TIMEBLOCKS):
-            Hloc = copy.deepcopy(H)
-            Hloc['CRVAL6'] += Hloc['CDELT6'] * starts[j]
-            headers.append(Hloc)
-
-        for timeslot in range(TIMEBLOCKS):
-            # Do this timeslot, one at the time.
-            print('Processing timeslot '+str(timeslot))
-            start = starts[timeslot]
-            numtimesteps = datasizes[timeslot]
-            head = headers[timeslot]
-
-            timeslot_shape = list(shape)
-            timeslot_shape[0] = numtimesteps
-            data_int = np.zeros(tuple(timeslot_shape),dtype=np.float32)
-
-            fitslist = glob.glob('partfits*')
-            fitsnums = [int(fit.split('_')[1].split('.')[0]) for fit in fitslist]
-            fitsnums = np.sort(np.array(fitsnums))
-            fitslist = [f'partfits_{i}.fits' for i in fitsnums]
-            for j in fitsnums:
-                data_int[:,j,:,:,:,:] = fits.getdata(fitslist[j])[start:start+numtimesteps,:,:,:,:]
-
-            hdu = fits.PrimaryHDU(header=head)
-            hdu.data = data_int
-            del data_int
-            hdu.writeto(f'{fitsfilename_prefix}_timeslot{timeslot}.fits')
-            del hdu.data
-            del hdu
-            gc.collect()
-
-
+        # HDF5 is written by this process only, the workers send back their screens
+        if ncpu > 1:
+            pl = mp.get_context('fork').Pool(ncpu)
+            results = pl.imap_unordered(compute_workunit, tasks)
+        else:
+            results = map(compute_workunit, tasks)
+        for ifreq, antennas, data_station, tstart in results:
+            write_h5_screen(h5screen.root.screen, ifreq, antennas, data_station, tstart=tstart)
+        if ncpu > 1:
+            pl.close()
+            pl.join()
+        h5screen.close()
+        print('Wrote', h5filename, ', use screen_io.py to convert it to FITS')
+
+    save_screen_cache(cachefile, settings, units)
+finally:
+    release_shared_memory()
+print('Finished interpolating.')
@@ -0,0 +1,176 @@
+"""
+Storage backends for the gain screens made by make_gain_multithreaded.py
+
+The screen has shape (time, freq, ant, matrix, y, x). It is either written straight into
+preallocated (memory-mapped) FITS files, or into a chunked and compressed HDF5 file with one
+chunk per (time block, freq, ant). The FITS header is stored with the HDF5 screen, so the
+FITS (or timeslot FITS) files for the imager can be made on demand:
+
+python screen_io.py --h5screen gainscreen_rbf.h5 --FITSscreen gainscreen_rbf.fits --timeblocks 4
+
+A small JSON cache file next to the output records a hash of the inputs of every
+(freq, station, time block) part of the screen, so a rerun only has to recompute the parts
+whose input gains changed.
+"""
+
+import copy
+import json
+import os
+import numpy as np
+import tables
+from astropy.io import fits
+
+
+def screen_blocks(H, fitsfilename, timeblocks=1):
+    '''
+        Split the output screen in timeblocks, returns a list of (filename, header, start, ntimes)
+    '''
+    ntimes_total = H['NAXIS6']
+    if timeblocks == 1:
+        return [(fitsfilename, H, 0, ntimes_total)]
+    fitsfilename_prefix = fitsfilename.split('.fits')[0]
+    timesteps_per_block = ntimes_total//timeblocks
+    blocks = []
+    for timeslot in range(timeblocks):
+        start = timeslot*timesteps_per_block
+        if timeslot == timeblocks-1:
+            numtimesteps = ntimes_total - start
+        else:
+            numtimesteps = timesteps_per_block
+        Hloc = copy.deepcopy(H)
+        Hloc['NAXIS6'] = numtimesteps
+        Hloc['CRVAL6'] += Hloc['CDELT6'] * start
+        blocks.append((f'{fitsfilename_prefix}_timeslot{timeslot}.fits', Hloc, start, numtimesteps))
+    return blocks
+
+def fits_shape(H):
+    return tuple([H[f'NAXIS{i+1}'] for i in range(H['NAXIS'])][::-1]) # Byte order is inverted for fits files
+
+def create_fits_on_disk(filename, H):
+    '''
+        Preallocate a FITS file on disk (header + zero filled data) without building the data in RAM
+    '''
+    headerstring = H.tostring().encode('ascii')
+    nbytes = int(np.prod(fits_shape(H)))*4 # BITPIX -32
+    nbytes = ((nbytes + 2879)//2880)*2880 # FITS blocks
+    with open(filename, 'wb') as fobj:
+        fobj.write(headerstring)
+        fobj.truncate(len(headerstring) + nbytes)
+
+def fits_on_disk_matches(filename, H):
+    '''
+        Check if a file made by create_fits_on_disk exists with exactly header H, so it can be written into again
+    '''
+    headerstring = H.tostring().encode('ascii')
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as fobj:
+        return fobj.read(len(headerstring)) == headerstring
+
+def open_fits_memmap(filename, H):
+    '''
+        Open the data of a file made by create_fits_on_disk as a writable memmap
+    '''
+    offset = len(H.tostring())
+    return np.memmap(filename, dtype='>f4', mode='r+', offset=offset, shape=fits_shape(H))
+
+def write_fits_screen(blocks, ifreq, antennas, data_station, tstart=0):
+    '''
+        Write the screen of one frequency slot (time, matrix, y, x) for the given antennas into the FITS blocks
+        data_station starts at timeslot tstart, only the blocks that overlap with it are written
+    '''
+    tstop = tstart + len(data_station)
+    for filename, head, start, numtimesteps in blocks:
+        t0, t1 = max(start, tstart), min(start+numtimesteps, tstop)
+        if t0 >= t1:
+            continue
+        data_out = open_fits_memmap(filename, head)
+        for antenna in antennas:
+            data_out[t0-start:t1-start, ifreq, antenna, :, :, :] = data_station[t0-tstart:t1-tstart]
+        data_out.flush()
+        del data_out
+
+def create_h5_screen(filename, H, timeblocks=1, complevel=5):
+    '''
+        Create a chunked, compressed HDF5 screen with the FITS header stored as attribute
+        One chunk holds one time block of a single (freq, ant), which is how the screens are written
+    '''
+    shape = fits_shape(H)
+    chunkshape = (max(1, shape[0]//timeblocks), 1, 1) + shape[3:]
+    h5 = tables.open_file(filename, 'w')
+    screen = h5.create_carray(h5.root, 'screen', atom=tables.Float32Atom(), shape=shape, chunkshape=chunkshape,
+                              filters=tables.Filters(complevel=complevel, complib='zlib', shuffle=True))
+    screen.attrs.HEADER = H.tostring(sep='\n')
+    screen.attrs.TIMEBLOCKS = timeblocks
+    return h5
+
+def open_h5_screen(filename, H):
+    '''
+        Reopen an existing HDF5 screen for writing, returns None if it does not match header H
+    '''
+    if not os.path.isfile(filename):
+        return None
+    h5 = tables.open_file(filename, 'r+')
+    if 'screen' not in h5.root or h5.root.screen.attrs.HEADER != H.tostring(sep='\n'):
+        h5.close()
+        return None
+    return h5
+
+def write_h5_screen(screen, ifreq, antennas, data_station, tstart=0):
+    '''
+        Write the screen of one frequency slot (time, matrix, y, x) for the given antennas into the HDF5 screen
+        data_station starts at timeslot tstart
+    '''
+    for antenna in antennas:
+        screen[tstart:tstart+len(data_station), ifreq, antenna, :, :, :] = data_station
+
+def load_screen_cache(filename, settings):
+    '''
+        Return the {unit: hash} dictionary of a previous run, or an empty one if that run used other settings
+    '''
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as fobj:
+        cache = json.load(fobj)
+    if cache.get('settings') != settings:
+        return {}
+    return cache.get('units', {})
+
+def save_screen_cache(filename, settings, units):
+    with open(filename, 'w') as fobj:
+        json.dump({'settings': settings, 'units': units}, fobj)
+
+def h5_to_fits(h5screen, fitsfilename, timeblocks=None):
+    '''
+        Convert an HDF5 screen into the FITS (timeblocks=1) or timeslot FITS files for the imager
+        Only one (freq, ant) time block is in memory at any time
+    '''
+    with tables.open_file(h5screen, 'r') as h5:
+        screen = h5.root.screen
+        H = fits.Header.fromstring(screen.attrs.HEADER, sep='\n')
+        if timeblocks is None:
+            timeblocks = int(screen.attrs.TIMEBLOCKS)
+        shape = fits_shape(H)
+        blocks = screen_blocks(H, fitsfilename, timeblocks)
+        for filename, head, start, numtimesteps in blocks:
+            print('Writing', filename)
+            create_fits_on_disk(filename, head)
+            data_out = open_fits_memmap(filename, head)
+            for ifreq in range(shape[1]):
+                for antenna in range(shape[2]):
+                    data_out[:, ifreq, antenna, :, :, :] = screen[start:start+numtimesteps, ifreq, antenna, :, :, :]
+            data_out.flush()
+            del data_out
+    return [block[0] for block in blocks]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert an HDF5 gain screen made by make_gain_multithreaded.py to FITS screen file(s)')
+    parser.add_argument('--h5screen', help='Input HDF5 screen file', type=str, required=True)
+    parser.add_argument('--FITSscreen', help='Output FITS screen file', type=str, default='gainscreen_rbf.fits')
+    parser.add_argument('--timeblocks', help='Break up the FITS screen in timeblocks, default is the time chunking of the HDF5 screen', type=int, default=None)
+    args = parser.parse_args()
+
+    h5_to_fits(args.h5screen, args.FITSscreen, timeblocks=args.timeblocks)
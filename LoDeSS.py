@@ -17,6 +17,9 @@ from astropy.coordinates import SkyCoord
 import astropy.units as u
 import glob
 import bdsf
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lofar_facet_selfcal'))
+from ms_metadata import ms_metadata
+from lin2circ import applycal_circular
 
 
 '''
@@ -35,6 +38,8 @@ c3c196= np.array([2.15374139,0.8415521])
 ROOT_FOLDER = '/net/rijn/data2/groeneveld/LoDeSS_files/'
 HELPER_SCRIPTS = '/net/rijn/data2/groeneveld/LoDeSS_files/lofar_facet_selfcal/'
 FACET_PIPELINE = ROOT_FOLDER + 'lofar_facet_selfcal/facetselfcal.py'
+# modules from lofar_facet_selfcal that facetselfcal.py imports, they are copied next to every copy of it
+FACET_HELPERS = ['ms_metadata.py', 'BLsmooth.py', 'ms_columns.py', 'lin2circ.py']
 H5_HELPER = '/net/rijn/data2/groeneveld/lofar_helpers/'
 
 def run_cmd(s,proceed=False,dryrun=False,log=None,quiet=False):
@@ -90,9 +95,7 @@ def add_dummyms(msfiles):
 
     # Check for wrong REF_FREQUENCY which happens after a DPPP split in frequency
     for ms in msfiles:        
-        t = pt.table(ms + '/SPECTRAL_WINDOW', readonly=True)
-        freq = t.getcol('REF_FREQUENCY')[0]
-        t.close()
+        freq = ms_metadata(ms, 'ref_frequency')[0]
         freqaxis.append(freq)
     freqaxis = np.sort( np.array(freqaxis))
     minfreqspacing = np.min(np.diff(freqaxis))
@@ -102,12 +105,10 @@ def add_dummyms(msfiles):
     
     freqaxis = [] 
     for ms in msfiles:        
-        t = pt.table(ms + '/SPECTRAL_WINDOW', readonly=True)
         if keyname == 'CHAN_FREQ':
-          freq = t.getcol(keyname)[0][0]
+          freq = ms_metadata(ms, 'chan_freq')[0][0]
         else:
-          freq = t.getcol(keyname)[0]  
-        t.close()
+          freq = ms_metadata(ms, 'ref_frequency')[0]
         freqaxis.append(freq)
     
     # put everything in order of increasing frequency
@@ -170,8 +171,7 @@ def find_missing_stations():
 
     # Now look at ms
 
-    tab = pt.table(measurementset+'::ANTENNA')
-    antlist_ms = tab.getcol('NAME')
+    antlist_ms = list(ms_metadata(measurementset, 'antenna_names'))
 
     # compare them
 
@@ -194,6 +194,9 @@ def find_rms(thres = 0.002):
         Run this in the DD_cal directory. Iterates through all the run_X folders,
         finds the measurement sets and computes the snr
     '''
+    # runwsclean imports the FACET_HELPERS modules
+    if HELPER_SCRIPTS not in sys.path:
+        sys.path.append(HELPER_SCRIPTS)
     import runwsclean as runw
     msses = glob.glob('run*/direction*/Dir*ms')
     msfullnames = [ms.split('/')[-1] for ms in msses]
@@ -412,6 +415,16 @@ def calibrator(flagstation=None,nthreads=6):
     print(cmd)
     run_cmd(cmd,log='calibrator_facetselfcal.log')   
 
+def apply_calibrator(outname,calfile='calibrator.h5'):
+    '''
+        Go to circular, apply the calfile and go back to linear, in one pass over the data
+        DATA --> CALCORRECT_DATA (linear, for the phaseshift) and CALCORRECT_DATA_CIRC (circular,
+        consolidated_target applies the DI solutions to it)
+    '''
+    print(f'Applying {calfile} in circular polarization: {outname} DATA --> CALCORRECT_DATA, CALCORRECT_DATA_CIRC')
+    applycal_circular(outname, calfile, column='DATA', outcol='CALCORRECT_DATA', solset='sol000',
+                      soltabs=('phase000', 'amplitude000'), circcol='CALCORRECT_DATA_CIRC')
+
 def individual_target(Lnum,calfile,target,nthreads=6):
     '''
         This runs the individual target part of the pipeline
@@ -443,21 +456,7 @@ def individual_target(Lnum,calfile,target,nthreads=6):
     print(cmd)
     run_cmd(cmd)
 
-    # Go to circular ...
-    run_cmd(f'cp -r {ROOT_FOLDER}lin2circ.py .')
-    run_cmd(f'python lin2circ.py -i {outname} -c DATA -o DATA_CIRC')
-
-    # Now, apply the calfile
-
-    cmd = f'DPPP msin={outname} msout=. steps=[ac1,ac2] msout.datacolumn=CALCORRECT_DATA_CIRC msin.datacolumn=DATA_CIRC '
-    cmd += f'ac1.type=applycal ac1.parmdb=calibrator.h5 ac1.solset=sol000 ac1.correction=phase000 '
-    cmd += f'ac2.type=applycal ac2.parmdb=calibrator.h5 ac2.solset=sol000 ac2.correction=amplitude000 '
-    print(cmd)
-    run_cmd(cmd)
-
-    # ... and go back to linear
-
-    run_cmd(f'python lin2circ.py -i {outname} -c CALCORRECT_DATA_CIRC -b -l CALCORRECT_DATA')
+    apply_calibrator(outname)
     run_cmd(f'cp -r {outname} ../')
 
     # Phaseshift to target+average
@@ -538,6 +537,7 @@ def dd_pipeline(location,boxes,nthreads,target):
     os.chdir('DD_cal')
     run_cmd(f'cp -r {boxes} ./rectangles')
     run_cmd(f'cp -r {ROOT_FOLDER}DD/* .')
+    run_cmd(f'cp {ROOT_FOLDER}lofar_facet_selfcal/ms_metadata.py .')  # used by h5_merger.py
     run_cmd(f'cp -r ../DI_image/image_000-????-model.fits .')
     run_cmd(f'cp -r ../DI_image/*ms .')
 
@@ -560,7 +560,7 @@ def dd_pipeline(location,boxes,nthreads,target):
     os.chdir('../../')
 
 
-def DDF_pipeline(location,direction):
+def DDF_pipeline(location,direction,nthreads=6):
     '''
         This pipeline starts off where the DD pipeline stops:
         it checks what the noise is for 
@@ -569,6 +569,8 @@ def DDF_pipeline(location,direction):
         Also, make sure it gives two merged h5 files...
     '''
     run_cmd(f'cp -r {FACET_PIPELINE} runwsclean.py')
+    for helper in FACET_HELPERS:
+        run_cmd(f'cp {HELPER_SCRIPTS}{helper} .')
     os.chdir(location[0]) # Again, this should be the pointing name...
     if not os.path.isdir('DD_cal'):
         print("You need to perform DD calibration before running the facet-imaging pipeline. Also make sure that you are giving it the directory of the pointing (not the MS)")
@@ -585,18 +587,18 @@ def DDF_pipeline(location,direction):
         h5list = glob.glob('RESULTS/h5files/direction*h5')
         nums = [h5.split('.')[1] for h5 in h5list]
         n_max = np.max(np.array(nums,dtype=int))
-        for n in range(n_max + 1):
-            cmd = f'python h5_merger.py -out merged.{n}.h5 -in RESULTS/h5files/*.{n}.h5 --ms run_0/direction0/Dir0.{n}.peel.ms '
-            if direction != None:
-                crdlist = direction.lstrip('[').rstrip(']').split(',')
-                crdlist = [crd.split('deg')[0] for crd in crdlist]
-                crd = SkyCoord(*crdlist,unit = (u.deg,u.deg))
-                radiancoord = str([crd.ra.to(u.radian).value,crd.dec.to(u.radian).value]).replace(' ','')
-                cmd += f'--add_direction {radiancoord}'
-            print(cmd)
-            run_cmd(cmd)
-
-        pass
+        # one h5_merger run does the merges for all MS numbers in parallel, sharing the MS axes and h5 sources it reads
+        numbers = ' '.join([str(n) for n in range(n_max + 1)])
+        ncpu = min(int(nthreads), n_max + 1)
+        cmd = f"python h5_merger.py -out 'merged.{{n}}.h5' -in 'RESULTS/h5files/*.{{n}}.h5' --ms 'run_0/direction0/Dir0.{{n}}.peel.ms' --numbers {numbers} --ncpu {ncpu} "
+        if direction != None:
+            crdlist = direction.lstrip('[').rstrip(']').split(',')
+            crdlist = [crd.split('deg')[0] for crd in crdlist]
+            crd = SkyCoord(*crdlist,unit = (u.deg,u.deg))
+            radiancoord = str([crd.ra.to(u.radian).value,crd.dec.to(u.radian).value]).replace(' ','')
+            cmd += f'--add_direction {radiancoord}'
+        print(cmd)
+        run_cmd(cmd)
     else:
         # single ms
         cmd = f'python h5_merger.py -out merged.h5 -in RESULTS/h5files/* --ms run_0/direction0/Dir0.peel.ms '
@@ -633,7 +635,7 @@ if __name__ == "__main__":
     parse.add_argument('--cal_H5',help='H5 file from the calibrator source. This is used to make an initial correction', default=None,nargs='*')
     parse.add_argument('--direction',help='Direction to go to when using the target pipeline. Format: "[xxx.xxdeg,yyy.yydeg]"', default=None,type=str)
     parse.add_argument('--boxes', help='Folder with boxes, called DirXX. Needed for direction dependent calibration')
-    parse.add_argument('--nthreads', default=6, help='Amount of threads to be spawned by DD calibration. 5 will basically fill up a 96 core node (~100 load avg)')
+    parse.add_argument('--nthreads', default=6, help='Amount of threads to be spawned by DD calibration. 5 will basically fill up a 96 core node (~100 load avg). Also the number of h5 merges that the DDF pipeline runs at the same time')
     parse.add_argument('--demix', '--prerun',action = 'store_true', help='Do this if the folder contains raw .tar files instead of demixed folders. Untarring has to happen on the node itself - so from a performance POV this might not be a good choice.')
     parse.add_argument('--delete_files', action='store_true', help='Deletes files after running the pipelne. Only recommended for the calibrator pipeline!')
     parse.add_argument('--pipeline', help='Pipeline of choice', choices=['DD','DI_target','DI_calibrator','DDF','full'])
@@ -701,7 +703,7 @@ if __name__ == "__main__":
         initrun(location)
         target(calfiles_abs,res.direction,res.nthreads)
     elif res.pipeline=='DDF':
-        DDF_pipeline(location,res.direction)
+        DDF_pipeline(location,res.direction,res.nthreads)
     elif res.pipeline=='full':
         # Run the full pipeline.
         # This is useful BUT PLEASE CHECK
@@ -716,7 +718,7 @@ if __name__ == "__main__":
         wd = os.getcwd()
         dd_pipeline('./','./extract_directions/regions_ws1/',res.nthreads,None)
         os.chdir(wd)
-        DDF_pipeline('./',None)
+        DDF_pipeline('./',None,res.nthreads)
 
     if res.delete_files and res.pipeline == 'DI_calibrator':
         # Delete measurement sets. This should be the bulk anyways...
@@ -24,46 +24,65 @@
 import os, sys
 import optparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy.ndimage import gaussian_filter1d as gfilter
+from scipy.ndimage import correlate1d
 
 import casacore.tables as pt
 
-from lib_multiproc import multiprocManager
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
-logging.info('BL-based smoother - Francesco de Gasperin, Henrik Edler')
-
-
-def addcol(ms, incol, outcol):
-    """ Add a new column to a MS. """
+def addcol(ms, incol, outcol, copy=True):
+    """ Add a new column to a MS, copy=False skips copying the values when all rows are written anyway. """
     if outcol not in ms.colnames():
         logging.info('Adding column: '+outcol)
         coldmi = ms.getdminfo(incol)
         coldmi['NAME'] = outcol
         ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
-    if (outcol != incol):
+    if (outcol != incol) and copy:
         # copy columns val
         logging.info('Set '+outcol+'='+incol)
         pt.taql("UPDATE $ms SET "+outcol+"="+incol)
 
 
-def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
+_kernels = {} # Gaussian kernels per sigma, the sigmas are rounded by sigma_bin so nearby baselines share them
+
+
+def gaussian_kernel(sigma):
+    """
+    Normalised Gaussian kernel truncated at 3 sigma, the same as gaussian_filter1d(truncate=3) uses.
+    The kernels are cached, every bucket of baselines with this (binned) sigma and every chunk reuse it.
+    """
+    if sigma not in _kernels:
+        radius = int(3 * sigma + 0.5)
+        x = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+        _kernels[sigma] = kernel / kernel.sum()
+    return _kernels[sigma]
+
+
+def gfilter(data, sigma, axis):
+    """
+    Gaussian filter along one axis with a cached kernel
+    """
+    return correlate1d(data, gaussian_kernel(sigma), axis=axis, mode='reflect')
+
+
+def smooth_baselines(data, weights, std_t, std_f):
     """
-    Smooth one baseline.
+    Smooth a stack of baselines that share the same smoothing kernel.
     Multiply every element of the data by the weights, convolve both the
     scaled data and the weights, and then divide the convolved data by the
     convolved weights (translating flagged data into weight=0).
     That's basically the equivalent of a running weighted average with a
     Gaussian window function.
     see also: https://stackoverflow.com/questions/51728224/gaussian-filtering-image-with-a-cut-off-value-in-python
+    The weighted real and imaginary parts (or amplitudes) and the weights are stacked in one array,
+    so each axis is filtered with a single call.
 
     Parameters
     ----------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray
-        Data for one baseline that is to be smoothed.
+        Data (time, baseline, freq, pol) for the baselines that are to be smoothed.
     weights: ndarray
         Weight input.
     std_t: float
@@ -73,131 +92,61 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
 
     Returns
     -------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray.
-        Smoothed ata for one baseline.
+        Smoothed data for these baselines.
     weights: ndarray
         Weight output.
     """
-    data = np.nan_to_num(data * weights) # set bad data to 0 so nans don't propagate
-    if np.isnan(data).all():
-        return in_bl, data, weights # flagged ants
-    # smear weighted data and weights
+    # weighted data, set bad data to 0 so nans don't propagate
     if options.onlyamp: # smooth only amplitudes
-        dataAMP, dataPH = np.abs(data), np.angle(data)
-        if not options.notime:
-            dataAMP = gfilter(dataAMP, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataAMP = gfilter(dataAMP, std_f, axis=1, truncate=3)
-        data = dataAMP * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
+        data = np.nan_to_num(data * weights)
+        dataPH = np.angle(data)
+        stack = np.stack([np.abs(data), weights])
     else:
-        dataR, dataI = np.real(data), np.imag(data)
-        if not options.notime:
-            dataR = gfilter(dataR, std_t, axis=0, truncate=3)
-            dataI = gfilter(dataI, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataR = gfilter(dataR, std_f, axis=1, truncate=3)
-            dataI = gfilter(dataI, std_f, axis=1, truncate=3)
-        data = dataR + 1j*dataI # recreate data
+        stack = np.empty((3,) + data.shape, dtype=weights.dtype)
+        np.multiply(data.real, weights, out=stack[0])
+        np.multiply(data.imag, weights, out=stack[1])
+        np.nan_to_num(stack[:2], copy=False)
+        stack[2] = weights
+    # smear weighted data and weights (axis 0 of the stack is the quantity)
     if not options.notime:
-        weights = gfilter(weights, std_t, axis=0, truncate=3)
+        stack = gfilter(stack, std_t, axis=1)
     if not options.nofreq:
-        weights = gfilter(weights, std_f, axis=1, truncate=3)
+        stack = gfilter(stack, std_f, axis=3)
+    if options.onlyamp:
+        data = stack[0] * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
+    else:
+        data = stack[0] + 1j*stack[1] # recreate data
+    weights = stack[-1]
     data[(weights != 0)] /= weights[(weights != 0)]  # avoid divbyzero
+    return data, weights
 
-    # print( np.count_nonzero(data[~flags[in_bl]]), np.count_nonzero(data[flags[in_bl]]), 100*np.count_nonzero(data[flags[in_bl]])/np.count_nonzero(data))
-    # print( "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags[in_bl]])))
-    # print( "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags[in_bl]])))
-    # print( "NANs in weights: ", np.count_nonzero(np.isnan(weights)))
-    outQueue.put([in_bl, data, weights])
 
+def sigma_bin(sigma):
+    """
+    Round a smoothing sigma to a grid with a relative step of --sigmabin,
+    so baselines with almost the same length end up in the same bucket and share their kernels.
+    Without it the exact sigma differs for every baseline and nothing is shared.
+    """
+    if options.sigmabin <= 0:
+        return sigma
+    step = np.log1p(options.sigmabin)
+    return float(np.exp(np.round(np.log(sigma) / step) * step))
 
 
-opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 3.0")
-opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.01]', type='float', default=0.01)
-opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 1.0]', type='float', default=1.0)
-opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
-opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
-opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
-opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
-opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
-opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
-opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
-opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
-opt.add_option('-c', '--chunks', help='Split the I/O in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
-opt.add_option('-n', '--ncpu', help='Number of cores', default=4, type='int')
-(options, msfile) = opt.parse_args()
-
-if msfile == []:
-    opt.print_help()
-    sys.exit(0)
-msfile = msfile[0]
-if not os.path.exists(msfile):
-    logging.error("Cannot find MS file {}.".format(msfile))
-    sys.exit(1)
-# open input/output MS
-ms = pt.table(msfile, readonly=False, ack=False)
-
-with pt.table(msfile + '::SPECTRAL_WINDOW', ack=False) as freqtab:
-    freq = freqtab.getcol('REF_FREQUENCY')[0]
-    freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
-    timepersample = ms.getcell('INTERVAL',0)
-
-# get info on all baselines
-with pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)),GCOUNT() FROM $ms GROUPBY ANTENNA1,ANTENNA2") as BL:
-    ants1, ants2 = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2')
-    dists = BL.getcol('Col_3')/1e3 # baseleline length in km
-    n_t = BL.getcol('Col_4')[0] # number of timesteps
-    n_bl = len(ants1)
-
-# check if ms is time-ordered
-times = ms.getcol('TIME_CENTROID')
-if not all(np.diff(times) >= 0):
-    logging.critical('This code cannot handle MS that are not time-sorted.')
-    sys.exit(1)
-del times
-
-# create column to smooth
-addcol(ms, options.incol, options.outcol)
-# restore WEIGHT_SPECTRUM
-if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
-    addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
-# backup WEIGHT_SPECTRUM
-elif options.weight and not options.nobackup:
-    addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
-
-# Iterate over chunks of baselines
-for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
-    logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
-
-    # get input data for this chunk
-    ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
-    chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
-    data_chunk = chunk.getcol(options.incol)
-    weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
-    # flag NaNs and set weights to zero
-    flags = chunk.getcol('FLAG')
-    flags[np.isnan(data_chunk)] = True
-    weights_chunk[flags] = 0
-    del flags
-    # prepare output cols
-    smoothed_data = data_chunk.copy()
-    if options.weight:
-        new_weights = np.zeros_like(weights_chunk)
-
-    # Iterate on each baseline in this chunk
-    mpm = multiprocManager(options.ncpu, smooth_baseline)
-    for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists[idx])):
+def baseline_buckets(ants1_sel, ants2_sel, dists_sel):
+    """
+    Collect the baselines in buckets with the same smoothing kernel.
+    Returns a dictionary {(std_t, std_f): [baseline indices]}, baselines that are not smoothed are left out.
+    """
+    buckets = {}
+    for i_bl, (ant1, ant2, dist) in enumerate(zip(ants1_sel, ants2_sel, dists_sel)):
         if ant1 == ant2:
             continue  # skip autocorrelations
         elif np.isnan(dist):
             continue  # fix for missing antennas
         logging.debug('Working on baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
 
-        in_bl = slice(i_chunk, -1, len(ants1_chunk))  # All times for 1 BL
-        data, weights= data_chunk[in_bl], weights_chunk[in_bl]
-
         std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
         std_t = std_t / timepersample  # in samples
         # TODO: for freq this is hardcoded, it should be thought better
@@ -207,22 +156,239 @@ for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
         logging.debug("-Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
             std_t, timepersample * std_t, std_f, freqpersample * std_f / 1e6))
         if std_t < 0.5: continue  # avoid very small smoothing and flagged ants
-        # fill queue
-        mpm.put([in_bl, data, weights, std_t, std_f])
+        buckets.setdefault((sigma_bin(std_t), sigma_bin(std_f)), []).append(i_bl)
+    return buckets
+
+
+def smooth_buckets(buckets, data_bl, weights_bl, smoothed_bl, new_weights_bl=None, tsel=slice(None)):
+    """
+    Smooth all buckets of baselines with a thread pool.
+    The input arrays have shape (time, baseline, freq, pol), the output arrays get the timesteps tsel of the result.
+    scipy.ndimage releases the GIL, so threads work in parallel on the shared arrays.
+    """
+    # split large buckets so the threads stay busy
+    n_bucket_bl = max(1, sum([len(bls) for bls in buckets.values()]) // (2 * options.ncpu))
+    jobs = [(std, bls[i:i + n_bucket_bl]) for std, bls in buckets.items() for i in range(0, len(bls), n_bucket_bl)]
+    logging.debug('Smoothing {} baselines in {} buckets'.format(sum([len(bls) for bls in buckets.values()]), len(buckets)))
+
+    def smooth_job(job):
+        (std_t, std_f), bls = job
+        data, weights = smooth_baselines(data_bl[:, bls], weights_bl[:, bls], std_t, std_f)
+        smoothed_bl[:, bls] = data[tsel]
+        if new_weights_bl is not None:
+            new_weights_bl[:, bls] = weights[tsel]
+
+    with ThreadPoolExecutor(max_workers=options.ncpu) as pool:
+        list(pool.map(smooth_job, jobs))
+
+
+def read_rows(ms, startrow, nrow):
+    """
+    Read data and weights of contiguous rows, flagged data and NaNs get weight zero
+    """
+    data = ms.getcol(options.incol, startrow=startrow, nrow=nrow)
+    weights = ms.getcol('WEIGHT_SPECTRUM', startrow=startrow, nrow=nrow)
+    flags = ms.getcol('FLAG', startrow=startrow, nrow=nrow)
+    flags[np.isnan(data)] = True
+    weights[flags] = 0
+    return data, weights
+
+
+def transform_phasediff(data):
+    """
+    Phase difference RR-LL with amplitude 0.5 in RR and LL (I = (RR+LL)/2), for scalarphasediff solves
+    """
+    phasediff = np.angle(data[..., 0]) - np.angle(data[..., 3])
+    data[..., 0] = 0.5 * np.exp(1j * phasediff)
+    data[..., 3] = data[..., 0]
+    return data
+
 
-    mpm.wait() # run queue
-    # reconstruct chunk column
-    for in_bl, data, weights in mpm.get():
-        smoothed_data[in_bl] = data
+def transform_phaseonly(data):
+    """
+    Unit amplitude RR and LL (or XX and YY), for _phmin solves
+    """
+    data[..., 0] = np.exp(1j * np.angle(data[..., 0]))
+    data[..., 3] = np.exp(1j * np.angle(data[..., 3]))
+    return data
+
+
+def transform_phaseslope(data, ampnorm=False):
+    """
+    Phase difference between neighbouring channels of RR and LL (or XX and YY), for _slope solves
+    The difference reduces the length of the freq axis by one, the last channel is set to the second to last
+    ampnorm=True gives unit amplitudes, otherwise the amplitudes of the data are kept
+    """
+    for pol in [0, 3]:
+        phasediff = np.angle(data[..., :-1, pol]) - np.angle(data[..., 1:, pol])
+        if ampnorm:
+            data[..., :-1, pol] = np.exp(1j * phasediff)
+        else:
+            data[..., :-1, pol] = np.abs(data[..., :-1, pol]) * np.exp(1j * phasediff)
+    data[..., -1, :] = data[..., -2, :]
+    return data
+
+
+transforms = {'phasediff': transform_phasediff, 'phaseonly': transform_phaseonly, 'phaseslope': transform_phaseslope}
+
+
+opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 3.0")
+opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.01]', type='float', default=0.01)
+opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 1.0]', type='float', default=1.0)
+opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
+opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
+opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
+opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
+opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
+opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
+opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
+opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
+opt.add_option('-c', '--chunks', help='Split the I/O in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
+opt.add_option('-n', '--ncpu', help='Number of cores', default=4, type='int')
+opt.add_option('-T', '--timeblock', help='Stream the MS in contiguous blocks of this many timesteps instead of --chunks of baselines, memory is set by the block plus the time smoothing window. Needs all baselines in every timestep [default: 0, no streaming]', default=0, type='int')
+opt.add_option('-x', '--transform', help='Transform the smoothed data before it is written to the output column, so derived columns are made in the same pass: phasediff, phaseonly or phaseslope [default: none]', type='choice', choices=list(transforms.keys()), default=None)
+opt.add_option('-g', '--sigmabin', help='Baselines with smoothing sigmas within this relative step are smoothed together with one kernel, this is faster but the sigmas change by up to half the step (half a percent with the default), 0 uses the exact sigma of every baseline [default: 0.01]', default=0.01, type='float')
+
+
+def smooth_ms(args=None):
+    """
+    Run the smoother with these command line arguments (default sys.argv), other scripts can run it in-process:
+    smooth_ms(['-i', 'DATA', '-o', 'DATA_CIRCULAR_PHASEDIFF', '-x', 'phasediff', 'test.ms'])
+    A ValueError is raised for a MS that cannot be smoothed, so the caller is not exited.
+    """
+    global options, freq, freqpersample, timepersample
+    logging.info('BL-based smoother - Francesco de Gasperin, Henrik Edler')
+    (options, msfile) = opt.parse_args(args)
+
+    if msfile == []:
+        raise ValueError('No MS file given.')
+    msfile = msfile[0]
+    if not os.path.exists(msfile):
+        raise ValueError('Cannot find MS file {}.'.format(msfile))
+    # open input/output MS
+    ms = pt.table(msfile, readonly=False, ack=False)
+
+    with pt.table(msfile + '::SPECTRAL_WINDOW', ack=False) as freqtab:
+        freq = freqtab.getcol('REF_FREQUENCY')[0]
+        freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
+        timepersample = ms.getcell('INTERVAL',0)
+
+    # get info on all baselines
+    with pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)),GCOUNT() FROM $ms GROUPBY ANTENNA1,ANTENNA2") as BL:
+        ants1, ants2 = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2')
+        dists = BL.getcol('Col_3')/1e3 # baseleline length in km
+        n_t = BL.getcol('Col_4')[0] # number of timesteps
+        n_bl = len(ants1)
+
+    # check if ms is time-ordered
+    times = ms.getcol('TIME_CENTROID')
+    if not all(np.diff(times) >= 0):
+        ms.close()
+        raise ValueError('This code cannot handle MS that are not time-sorted.')
+    del times
+
+    transform = transforms[options.transform] if options.transform else (lambda data: data)
+
+    # create column to smooth, all its rows are written below
+    addcol(ms, options.incol, options.outcol, copy=False)
+    # restore WEIGHT_SPECTRUM
+    if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
+        addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
+    # backup WEIGHT_SPECTRUM
+    elif options.weight and not options.nobackup:
+        addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
+
+    if options.timeblock > 0:
+        # Stream contiguous blocks of full timesteps, keeping a window of +-3 sigma timesteps around the block
+        if ms.nrows() != n_t * n_bl or not (np.array_equal(ms.getcol('ANTENNA1', 0, n_bl), ants1) and
+                                            np.array_equal(ms.getcol('ANTENNA2', 0, n_bl), ants2)):
+            ms.close()
+            raise ValueError('Streaming needs all baselines in every timestep, in the same order. Use --chunks instead.')
+        buckets = baseline_buckets(ants1, ants2, dists)
+        pad = 0 if options.notime else max([int(3 * std_t + 0.5) for std_t, std_f in buckets.keys()] + [0]) # gaussian_filter1d radius
+        logging.info('Streaming {} timesteps in blocks of {} with a window of +-{} timesteps'.format(n_t, options.timeblock, pad))
+
+        win_start, win_data, win_weights = 0, None, None # window with timesteps [win_start, win_start + len(win_data))
+        for t0 in range(0, n_t, options.timeblock):
+            t1 = min(t0 + options.timeblock, n_t)
+            w0, w1 = max(t0 - pad, 0), min(t1 + pad, n_t)
+            logging.debug('### Smoothing timesteps {}-{}'.format(t0, t1))
+
+            # drop the timesteps before the window and read the new ones
+            read0 = w0 if win_data is None else win_start + len(win_data)
+            if win_data is not None:
+                win_data, win_weights = win_data[w0 - win_start:], win_weights[w0 - win_start:]
+            if w1 > read0:
+                data, weights = read_rows(ms, read0 * n_bl, (w1 - read0) * n_bl)
+                data = data.reshape((w1 - read0, n_bl) + data.shape[1:])
+                weights = weights.reshape(data.shape)
+                if win_data is None:
+                    win_data, win_weights = data, weights
+                else:
+                    win_data, win_weights = np.concatenate([win_data, data]), np.concatenate([win_weights, weights])
+            win_start = w0
+
+            tsel = slice(t0 - w0, t1 - w0)
+            smoothed_bl = win_data[tsel].copy()
+            new_weights_bl = np.zeros_like(win_weights[tsel]) if options.weight else None
+            smooth_buckets(buckets, win_data, win_weights, smoothed_bl, new_weights_bl, tsel)
+
+            # write to ms
+            ms.putcol(options.outcol, transform(smoothed_bl).reshape((-1,) + smoothed_bl.shape[2:]), startrow=t0 * n_bl, nrow=(t1 - t0) * n_bl)
+            if options.weight:
+                ms.putcol('WEIGHT_SPECTRUM', new_weights_bl.reshape((-1,) + new_weights_bl.shape[2:]), startrow=t0 * n_bl, nrow=(t1 - t0) * n_bl)
+        logging.info('Written %s column.' % options.outcol)
         if options.weight:
-            new_weights[in_bl] = weights
-    # write to ms
-    logging.info('Writing %s column.' % options.outcol)
-    chunk.putcol(options.outcol, smoothed_data)
-    if options.weight:
-        logging.warning('Writing WEIGHT_SPECTRUM column.')
-        chunk.putcol('WEIGHT_SPECTRUM', new_weights)
-    chunk.close()
-
-ms.close()
-logging.info("Done.")
+            logging.warning('Written WEIGHT_SPECTRUM column.')
+    else:
+        # Iterate over chunks of baselines
+        for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
+            logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
+
+            # get input data for this chunk
+            ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
+            chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
+            data_chunk = chunk.getcol(options.incol)
+            weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
+            # flag NaNs and set weights to zero
+            flags = chunk.getcol('FLAG')
+            flags[np.isnan(data_chunk)] = True
+            weights_chunk[flags] = 0
+            del flags
+            # prepare output cols
+            smoothed_data = data_chunk.copy()
+            if options.weight:
+                new_weights = np.zeros_like(weights_chunk)
+
+            # views with shape (time, baseline, freq, pol), the rows are time-ordered with the same baselines every timestep
+            if len(data_chunk) != n_t * len(idx):
+                chunk.close()
+                ms.close()
+                raise ValueError('This code cannot handle MS where not all baselines have all timesteps.')
+            shape_bl = (n_t, len(idx)) + data_chunk.shape[1:]
+            smooth_buckets(baseline_buckets(ants1_chunk, ants2_chunk, dists[idx]),
+                           data_chunk.reshape(shape_bl), weights_chunk.reshape(shape_bl), smoothed_data.reshape(shape_bl),
+                           new_weights.reshape(shape_bl) if options.weight else None)
+
+            # write to ms
+            logging.info('Writing %s column.' % options.outcol)
+            chunk.putcol(options.outcol, transform(smoothed_data))
+            if options.weight:
+                logging.warning('Writing WEIGHT_SPECTRUM column.')
+                chunk.putcol('WEIGHT_SPECTRUM', new_weights)
+            chunk.close()
+
+    ms.close()
+    logging.info("Done.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
+    if opt.parse_args()[1] == []:
+        opt.print_help()
+        sys.exit(0)
+    try:
+        smooth_ms()
+    except ValueError as e:
+        logging.critical(e)
+        sys.exit(1)
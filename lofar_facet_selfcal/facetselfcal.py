@@ -41,6 +41,9 @@ import astropy.stats
 import astropy
 from astroquery.skyview import SkyView
 import pyrap.tables as pt
+from ms_metadata import ms_metadata
+from BLsmooth import smooth_ms, transform_phasediff, transform_phaseonly, transform_phaseslope
+from ms_columns import map_columns, fill_column
 import os.path
 from losoto import h5parm
 import bdsf
@@ -55,6 +58,7 @@ import multiprocessing
 import ast
 from lofar.stationresponse import stationresponse
 from itertools import product
+from functools import partial
 import subprocess
 import matplotlib.pyplot as plt
 from astropy.wcs import WCS
@@ -153,9 +157,7 @@ def preapply(H5filelist, mslist, updateDATA=True):
    return
 
 def time_match_mstoH5(H5filelist, ms):
-   t = pt.table(ms)
-   timesms = np.unique(t.getcol('TIME'))
-   t.close()
+   timesms = ms_metadata(ms, 'times')
    H5filematch = None
   
    for H5file in H5filelist:
@@ -267,31 +269,8 @@ def create_phase_slope(inmslist, incol='DATA', outcol='DATA_PHASE_SLOPE', ampnor
    if not isinstance(inmslist,list):
       inmslist = [inmslist] 
    for ms in inmslist:
-     t = pt.table(ms, readonly=False, ack=True)    
-     if outcol not in t.colnames():
-       print('Adding',outcol,'to',ms)            
-       desc = t.getcoldesc(incol)
-       newdesc = pt.makecoldesc(outcol, desc)
-       newdmi = t.getdminfo(incol)
-       newdmi['NAME'] = 'Dysco' + outcol
-       t.addcols(newdesc, newdmi) 
-     data = t.getcol(incol)
-     dataslope = np.copy(data)
-     for ff in range(data.shape[1]-1):
-       if ampnorm:
-         dataslope[:,ff,0] = np.copy(np.exp(1j * (np.angle(data[:,ff,0])-np.angle(data[:,ff+1,0]))))
-         dataslope[:,ff,3] = np.copy(np.exp(1j * (np.angle(data[:,ff,3])-np.angle(data[:,ff+1,3]))))
-       else:
-         dataslope[:,ff,0] = np.copy(np.abs(data[:,ff,0])*np.exp(1j * (np.angle(data[:,ff,0])-np.angle(data[:,ff+1,0]))))
-         dataslope[:,ff,3] = np.copy(np.abs(data[:,ff,3])*np.exp(1j * (np.angle(data[:,ff,3])-np.angle(data[:,ff+1,3]))))
-       
-     #last freq set to second to last freq because difference reduces length of freq axis with one
-     dataslope[:,-1,:] = np.copy(dataslope[:,-2,:])
-     t.putcol(outcol, dataslope) 
-     t.close()
-     #print( np.nanmedian(np.abs(data)))
-     #print( np.nanmedian(np.abs(dataslope)))
-     del data, dataslope
+     # phase difference between neighbouring channels, the last freq is set to the second to last
+     map_columns(ms, [(incol, outcol, partial(transform_phaseslope, ampnorm=ampnorm))])
    return
 
 
@@ -299,77 +278,22 @@ def create_phasediff_column(inmslist, incol='DATA', outcol='DATA_CIRCULAR_PHASED
    if not isinstance(inmslist,list):
       inmslist = [inmslist] 
    for ms in inmslist:
-     t = pt.table(ms, readonly=False, ack=True)    
-     if outcol not in t.colnames():
-       print('Adding',outcol,'to',ms)            
-       desc = t.getcoldesc(incol)
-       newdesc = pt.makecoldesc(outcol, desc)
-       newdmi = t.getdminfo(incol)
-       newdmi['NAME'] = 'Dysco' + outcol
-       t.addcols(newdesc, newdmi) 
-     
-    
-     data = t.getcol(incol)
-     phasediff =  np.copy(np.angle(data[:,:,0]) - np.angle(data[:,:,3])) #RR - LL
-     data[:,:,0] = 0.5*np.exp(1j * phasediff) # because I = RR+LL/2 (this is tricky because we work with phase diff)
-     data[:,:,3] = data[:,:,0]
-     t.putcol(outcol, data) 
-     t.close()
-     del data
-     del phasediff
-     
-     
-     if False:
-        #data = t.getcol(incol)
-        #t.putcol(outcol, data)
-        #t.close()
-        
-        time.sleep(2)
-        cmd = "taql 'update " + ms + " set " 
-        cmd += outcol + "[,0]=0.5*EXP(1.0i*(PHASE(" + incol + "[,0])-PHASE(" + incol + "[,3])))'"
-        #cmd += outcol + "[,3]=" + outcol + "[,0],"
-        #cmd += outcol + "[,1]=0+0i,"
-        #cmd += outcol + "[,2]=0+0i'"
-        print(cmd)
-        os.system(cmd)
-        cmd = "taql 'update " + ms + " set " 
-        #cmd += outcol + "[,0]=0.5*EXP(1.0i*(PHASE(" + incol + "[,0])-PHASE(" + incol + "[,3]))),"
-        cmd += outcol + "[,3]=" + outcol + "[,0]'"
-        #cmd += outcol + "[,1]=0+0i,"
-        #cmd += outcol + "[,2]=0+0i'"
-        print(cmd)
-        os.system(cmd)
+     # RR - LL phase with amplitude 0.5, because I = RR+LL/2 (this is tricky because we work with phase diff)
+     map_columns(ms, [(incol, outcol, transform_phasediff)])
    return
 
 def create_phase_column(inmslist, incol='DATA', outcol='DATA_PHASEONLY'):
    if not isinstance(inmslist,list):
       inmslist = [inmslist] 
    for ms in inmslist:
-     t = pt.table(ms, readonly=False, ack=True)    
-     if outcol not in t.colnames():
-       print('Adding',outcol,'to',ms)            
-       desc = t.getcoldesc(incol)
-       newdesc = pt.makecoldesc(outcol, desc)
-       newdmi = t.getdminfo(incol)
-       newdmi['NAME'] = 'Dysco' + outcol
-       t.addcols(newdesc, newdmi) 
-     data = t.getcol(incol)
-     data[:,:,0] = np.copy(np.exp(1j * np.angle(data[:,:,0]))) # because I = xx+yy/2
-     data[:,:,3] = np.copy(np.exp(1j * np.angle(data[:,:,3]))) # because I = xx+yy/2
-     t.putcol(outcol, data) 
-     t.close()
-     del data
+     map_columns(ms, [(incol, outcol, transform_phaseonly)]) # because I = xx+yy/2
    return
 
 def create_MODEL_DATA_PDIFF(inmslist):
    if not isinstance(inmslist,list):
       inmslist = [inmslist] 
    for ms in inmslist:
-     os.system('DP3 msin=' + ms + ' msout=. msout.datacolumn=MODEL_DATA_PDIFF steps=[]')
-     os.system("taql" + " 'update " + ms + " set MODEL_DATA_PDIFF[,0]=(0.5+0i)'") # because I = RR+LL/2 (this is tricky because we work with phase diff)
-     os.system("taql" + " 'update " + ms + " set MODEL_DATA_PDIFF[,3]=(0.5+0i)'") # because I = RR+LL/2 (this is tricky because we work with phase diff)
-     os.system("taql" + " 'update " + ms + " set MODEL_DATA_PDIFF[,1]=(0+0i)'")
-     os.system("taql" + " 'update " + ms + " set MODEL_DATA_PDIFF[,2]=(0+0i)'")
+     fill_column(ms, 'MODEL_DATA_PDIFF', [0.5, 0., 0., 0.5]) # because I = RR+LL/2 (this is tricky because we work with phase diff)
 
 def fulljonesparmdb(h5):
     H=tables.open_file(h5) 
@@ -974,12 +898,7 @@ def inputchecker(args):
   
 
 def get_uvwmax(ms):
-    t = pt.table(ms)
-    uvw = t.getcol('UVW')
-    ssq = np.sqrt(np.sum(uvw**2, axis=1))
-    print(uvw.shape)
-    t.close()
-    return np.max(ssq)    
+    return float(ms_metadata(ms, 'uvwmax'))    
 
 def makeBBSmodelforTGSS(boxfile=None, fitsimage=None, pixelscale=None, imsize=None, ms=None):
 
@@ -1973,11 +1892,9 @@ def setinitial_solint(mslist, soltype_list, longbaseline, LBA,\
    return nchan_list, solint_list, smoothnessconstraint_list, smoothnessreffrequency_list, antennaconstraint_list, soltypecycles_list
 
 def getmsmodelinfo(ms, modelcolumn, fastrms=False, uvcutfraction=0.333):
-   t = pt.table(ms + '/SPECTRAL_WINDOW')
-   chanw = np.median(t.getcol('CHAN_WIDTH'))
-   freq = np.median(t.getcol('CHAN_FREQ'))
-   nfreq = len(t.getcol('CHAN_FREQ')[0])
-   t.close()
+   chanw = np.median(ms_metadata(ms, 'chan_width'))
+   freq = np.median(ms_metadata(ms, 'chan_freq'))
+   nfreq = len(ms_metadata(ms, 'chan_freq')[0])
    uvdismod = get_uvwmax(ms)*uvcutfraction # take range [uvcutfraction*uvmax - 1.0uvmax]
    
    HBA_upfreqsel = 0.75 # select only freqcencies above 75% of the available bandwidth
@@ -3099,9 +3016,7 @@ def getdeclinationms(ms):
     input: a ms
     output: declination in degrees
     '''
-    t = pt.table(ms +'/FIELD', readonly=True)
-    direction = np.squeeze ( t.getcol('PHASE_DIR') )
-    t.close()
+    direction = np.squeeze ( ms_metadata(ms, 'phase_dir') )
     return 360.*direction[1]/(2.*np.pi)
 
 #print getdeclinationms('1E216.dysco.sub.shift.avg.weights.set0.ms')
@@ -3655,15 +3570,27 @@ def runDPPPbase(ms, solint, nchan, parmdb, soltype, longbaseline=False, uvmin=0,
     
     
     modeldata = 'MODEL_DATA' # the default, update if needed for scalarphasediff and phmin solves
+
+    # derived data column for the solve, with BLsmooth it is made in the same pass as the smoothing
+    transform, smoothcol = None, 'SMOOTHED_DATA'
+    if soltype == 'scalarphasediff' or soltype == 'scalarphasediffFR':
+      transform, smoothcol = 'phasediff', 'DATA_CIRCULAR_PHASEDIFF'
+    if soltype in ['phaseonly_phmin', 'rotation_phmin', 'tec_phmin', 'tecandphase_phmin','scalarphase_phmin']:
+      transform, smoothcol = 'phaseonly', 'DATA_PHASEONLY'
+    if soltype in ['phaseonly_slope', 'scalarphase_slope']:
+      transform, smoothcol = 'phaseslope', 'DATA_PHASE_SLOPE'
+
     if BLsmooth:
-      print('python BLsmooth.py -n 8 -i '+ incol + ' -o SMOOTHED_DATA -f ' + str(ionfactor) + \
-                ' -s ' + str(blscalefactor) + ' ' + ms)
-      os.system('python BLsmooth.py -n 8 -i '+ incol + ' -o SMOOTHED_DATA -f ' + str(ionfactor) + \
-                ' -s ' + str(blscalefactor) + ' ' + ms)        
-      incol = 'SMOOTHED_DATA'    
+      blsmoothargs = ['-n', '8', '-i', incol, '-o', smoothcol, '-f', str(ionfactor), '-s', str(blscalefactor)]
+      if transform is not None:
+        blsmoothargs += ['-x', transform]
+      print('python BLsmooth.py ' + ' '.join(blsmoothargs) + ' ' + ms)
+      smooth_ms(blsmoothargs + [ms])
+      incol = smoothcol
 
     if soltype == 'scalarphasediff' or soltype == 'scalarphasediffFR':
-      create_phasediff_column(ms, incol=incol)
+      if not BLsmooth:
+        create_phasediff_column(ms, incol=incol)
       soltype = 'phaseonly' # do this type of solve, maybe scalarphase is fine? 'scalarphase' #
       incol='DATA_CIRCULAR_PHASEDIFF'
       skymodel = None # solve out of MODEL_DATA complex(1,0)
@@ -3680,25 +3607,24 @@ def runDPPPbase(ms, solint, nchan, parmdb, soltype, longbaseline=False, uvmin=0,
 
 
     if skymodelpointsource !=None and soltypein != 'scalarphasediff' and soltypein != 'scalarphasediffFR':
-        # create MODEL_DATA (no dysco!)
-        os.system('DP3 msin=' + ms + ' msout=. msout.datacolumn=MODEL_DATA steps=[]')
-        # do the predict with taql
-        os.system("taql" + " 'update " + ms + " set MODEL_DATA[,0]=(" + str(skymodelpointsource)+ "+0i)'")
-        os.system("taql" + " 'update " + ms + " set MODEL_DATA[,3]=(" + str(skymodelpointsource)+ "+0i)'")
-        os.system("taql" + " 'update " + ms + " set MODEL_DATA[,1]=(0+0i)'")
-        os.system("taql" + " 'update " + ms + " set MODEL_DATA[,2]=(0+0i)'")
+        # create MODEL_DATA (no dysco!) and do the predict in one write
+        fill_column(ms, 'MODEL_DATA', [skymodelpointsource, 0., 0., skymodelpointsource])
         
 
     if soltype in ['phaseonly_phmin', 'rotation_phmin', 'tec_phmin', 'tecandphase_phmin','scalarphase_phmin']:
-      create_phase_column(ms, incol=incol, outcol='DATA_PHASEONLY')
-      create_phase_column(ms, incol='MODEL_DATA', outcol='MODEL_DATA_PHASEONLY')
+      jobs = [('MODEL_DATA', 'MODEL_DATA_PHASEONLY', transform_phaseonly)] # data and model in one pass
+      if not BLsmooth: # otherwise DATA_PHASEONLY was made while smoothing
+        jobs.insert(0, (incol, 'DATA_PHASEONLY', transform_phaseonly))
+      map_columns(ms, jobs)
       soltype = soltype.split('_phmin')[0]
       incol = 'DATA_PHASEONLY'
       modeldata = 'MODEL_DATA_PHASEONLY'
 
     if soltype in ['phaseonly_slope', 'scalarphase_slope']:
-      create_phase_slope(ms, incol=incol, outcol='DATA_PHASE_SLOPE', ampnorm=False)
-      create_phase_slope(ms, incol='MODEL_DATA', outcol='MODEL_DATA_PHASE_SLOPE', ampnorm=False)
+      jobs = [('MODEL_DATA', 'MODEL_DATA_PHASE_SLOPE', transform_phaseslope)] # data and model in one pass
+      if not BLsmooth: # otherwise DATA_PHASE_SLOPE was made while smoothing
+        jobs.insert(0, (incol, 'DATA_PHASE_SLOPE', transform_phaseslope))
+      map_columns(ms, jobs)
       soltype = soltype.split('_slope')[0]
       incol = 'DATA_PHASE_SLOPE'
       modeldata = 'MODEL_DATA_PHASE_SLOPE'      
@@ -53,14 +53,251 @@ YX = -iRR - iRL + iLR + iLL
 YY =   RR -  RL -  LR +  LL
 """
 
+import os
 import optparse
+from concurrent.futures import ThreadPoolExecutor
 import casacore.tables as pt
 import numpy
 
+# out[...,i] = sum_j M[i,j]*in[...,j] for the correlations in the order of the docstring above (including the factor 0.5)
+LIN2CIRC = 0.5*numpy.array([[1, -1j,  1j,  1],
+                            [1,  1j,  1j, -1],
+                            [1, -1j, -1j, -1],
+                            [1,  1j, -1j,  1]])
+CIRC2LIN = 0.5*numpy.array([[  1,   1,  1,   1],
+                            [ 1j, -1j, 1j, -1j],
+                            [-1j, -1j, 1j,  1j],
+                            [  1,  -1, -1,   1]])
+
+def available_memory():
+	'''
+	Available memory in bytes, MemAvailable from /proc/meminfo or the free pages if that is not there
+	'''
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])*1024
+	except (OSError, ValueError, IndexError):
+		pass
+	try:
+		return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+	except (ValueError, OSError, AttributeError):
+		return 2**30
+
+def rows_per_chunk(t, column, max_memory=None, nbuffers=3):
+	'''
+	Number of rows converted at once, so nbuffers row-sized arrays (by default the input and output
+	buffers and the copy casacore makes while reading or writing) fit in max_memory MB,
+	by default a quarter of the available memory (0 for an empty table)
+	'''
+	if t.nrows() == 0:
+		return 0
+	if max_memory is None:
+		max_memory = available_memory()/4./2**20
+	rowsize = t.getcell(column, 0).nbytes
+	return int(min(max(max_memory*2**20//(nbuffers*rowsize), 1), t.nrows()))
+
+def pipeline_chunks(t, stepsize, read, compute, write):
+	'''
+	Run read(row, nrow, slot), compute(nrow, slot) and write(row, nrow, slot) for all chunks of rows of table t,
+	double buffered (slot 0 or 1): chunk k+1 is read and chunk k-1 is written while chunk k is computed.
+	read and write run in a single I/O thread in the order they are submitted, so the table is never
+	accessed from two threads at once, compute runs in the calling thread (numpy releases the GIL).
+	'''
+	nrows = t.nrows()
+	if nrows == 0:
+		return
+	chunks = [(row, min(stepsize, nrows - row)) for row in range(0, nrows, stepsize)]
+	with ThreadPoolExecutor(max_workers=1) as io:
+		reads, writes = [io.submit(read, chunks[0][0], chunks[0][1], 0)], []
+		for k, (row, nrow) in enumerate(chunks):
+			print('Doing row', row, 'out of', nrows, row+nrow)
+			reads[k].result()
+			if k >= 2:
+				writes[k-2].result() # the output buffer of this slot is free again
+			if k+1 < len(chunks):
+				reads.append(io.submit(read, chunks[k+1][0], chunks[k+1][1], (k+1)%2))
+			compute(nrow, k%2)
+			writes.append(io.submit(write, row, nrow, k%2))
+		for write_done in writes:
+			write_done.result()
+
+def convert_column(t, column, outcol, matrix, max_memory=None):
+	'''
+	Apply the 4x4 correlation matrix to every visibility of column and write the result to outcol
+	The rows are done in chunks, reading and writing into two sets of buffers that are allocated once,
+	so the conversion of one chunk overlaps with the I/O of the neighbouring chunks
+	'''
+	if t.nrows() == 0:
+		return # nothing to convert, and no cell to get the shape from
+	stepsize = rows_per_chunk(t, column, max_memory, nbuffers=5)
+	cell = t.getcell(column, 0)
+	indata = numpy.empty((2, stepsize) + cell.shape, dtype=cell.dtype)
+	outdata = numpy.empty_like(indata)
+	matrixT = numpy.ascontiguousarray(matrix.T, dtype=cell.dtype)
+
+	def read(row, nrow, slot):
+		t.getcolnp(column, indata[slot, :nrow], startrow=row, nrow=nrow)
+
+	def compute(nrow, slot):
+		numpy.matmul(indata[slot, :nrow], matrixT, out=outdata[slot, :nrow])
+
+	def write(row, nrow, slot):
+		t.putcol(outcol, outdata[slot, :nrow], startrow=row, nrow=nrow)
+
+	pipeline_chunks(t, stepsize, read, compute, write)
+
+def nearest_index(interp_from, interp_to):
+	'''
+	Index of the nearest value in interp_from for every value of interp_to (extrapolating at the edges),
+	the nearest neighbour interpolation of solutions that DPPP applycal does
+	'''
+	interp_from = numpy.array(interp_from, dtype=float)
+	order = numpy.argsort(interp_from, kind='mergesort')
+	sorted_from = interp_from[order]
+	bounds = (sorted_from[1:] + sorted_from[:-1])/2.
+	idx = numpy.searchsorted(bounds, numpy.array(interp_to, dtype=float), side='left').clip(0, len(sorted_from)-1)
+	return order[idx]
+
+def solution_axes(values, names):
+	'''
+	Reorder the values of a soltab with axes names to (time, freq, ant, pol), missing axes get length 1
+	and other axes (dir) are reduced to their first element
+	'''
+	names = list(names)
+	for axis in [name for name in names if name not in ['time','freq','ant','pol']]:
+		values = numpy.take(values, 0, axis=names.index(axis))
+		names.remove(axis)
+	for axis in ['time','freq','ant','pol']:
+		if axis not in names:
+			values = values[..., numpy.newaxis]
+			names.append(axis)
+	return numpy.transpose(values, [names.index(axis) for axis in ['time','freq','ant','pol']])
+
+def read_corrections(h5name, antennas, solset='sol000', soltabs=('phase000','amplitude000')):
+	'''
+	Read the phase and/or amplitude solutions of a h5parm as inverse gains with axes (time, freq, ant, pol),
+	the antennas in the order of the MS. Other axes (dir) are reduced to their first element.
+	Solutions with weight 0 become NaN, so the data they apply to are flagged (as DPPP applycal does).
+	Returns a list of (inverse gains, solution times, solution freqs), one per soltab
+	'''
+	from losoto.h5parm import h5parm
+	H = h5parm(h5name, readonly=True)
+	ss = H.getSolset(solset)
+	corrections = []
+	for soltabname in soltabs:
+		st = ss.getSoltab(soltabname)
+		names = st.getAxesNames()
+		vals = solution_axes(st.getValues(retAxesVals=False), names)
+		weights = solution_axes(st.getValues(weight=True, retAxesVals=False), names)
+		if vals.shape[-1] not in [1,2]:
+			raise ValueError(soltabname + ' has ' + str(vals.shape[-1]) + ' polarizations, only diagonal solutions can be applied')
+
+		h5antennas = list(st.getAxisValues('ant'))
+		missing = [antenna for antenna in antennas if antenna not in h5antennas]
+		if len(missing) > 0:
+			raise ValueError('Antennas ' + ', '.join(missing) + ' are not in ' + h5name + ':' + soltabname)
+		antidx = [h5antennas.index(antenna) for antenna in antennas]
+		vals, weights = vals[:, :, antidx], weights[:, :, antidx]
+
+		if st.getType() == 'phase':
+			invgains = numpy.exp(-1j*vals)
+		elif st.getType() == 'amplitude':
+			invgains = 1./vals
+		else:
+			raise ValueError('Cannot apply ' + soltabname + ' of type ' + st.getType())
+		invgains[weights == 0] = numpy.nan
+		soltimes = st.getAxisValues('time') if 'time' in st.getAxesNames() else [0.]
+		solfreqs = st.getAxisValues('freq') if 'freq' in st.getAxesNames() else [0.]
+		corrections.append((invgains, soltimes, solfreqs))
+	H.close()
+	return corrections
+
+def applycal_circular(inms, h5name, column='DATA', outcol='CALCORRECT_DATA', solset='sol000',
+                      soltabs=('phase000','amplitude000'), max_memory=None, circcol=None):
+	'''
+	Convert linear data to circular, apply the (circular) solutions of a h5parm and convert back to linear
+	in a single chunked pass, instead of writing the circular and the corrected circular column in between.
+	If circcol is given, the corrected circular data is written to that column as well, in the same pass.
+	The solutions are interpolated to the times and frequencies of the MS with nearest neighbour, visibilities
+	that get a non-finite correction (in any correlation) are flagged, like DPPP applycal does.
+	'''
+	t = pt.table(inms, readonly=False, ack=True)
+	if column not in t.colnames():
+		print('Error: Input column does not exist')
+		t.close()
+		return
+	addcol(t, column, outcol, inms)
+	if circcol is not None:
+		addcol(t, column, circcol, inms)
+	if t.nrows() == 0:
+		t.close()
+		return
+
+	tant = pt.table(inms+'/ANTENNA', ack=False)
+	antennas = list(tant.getcol('NAME'))
+	tant.close()
+	tspw = pt.table(inms+'/SPECTRAL_WINDOW', ack=False)
+	chanfreqs = tspw.getcol('CHAN_FREQ')[0]
+	tspw.close()
+	corrections = [(invgains, soltimes, nearest_index(solfreqs, chanfreqs))
+	               for invgains, soltimes, solfreqs in read_corrections(h5name, antennas, solset, soltabs)]
+
+	# correlations RR, RL, LR, LL get the gains of polarization p of antenna 1 and q of antenna 2
+	pol1, pol2 = numpy.array([0,0,1,1]), numpy.array([0,1,0,1])
+	stepsize = rows_per_chunk(t, column, max_memory, nbuffers=10 if circcol is None else 12)
+	cell = t.getcell(column, 0)
+	indata = numpy.empty((2, stepsize) + cell.shape, dtype=cell.dtype)
+	outdata = numpy.empty_like(indata)
+	# the circular data is only needed during compute, unless it is written as well, then every slot gets its own
+	circdata = numpy.empty((1 if circcol is None else 2, stepsize) + cell.shape, dtype=cell.dtype)
+	lin2circT = numpy.ascontiguousarray(LIN2CIRC.T, dtype=cell.dtype)
+	circ2linT = numpy.ascontiguousarray(CIRC2LIN.T, dtype=cell.dtype)
+	rowinfo = [{}, {}] # TIME, ANTENNA1, ANTENNA2 and the new flags of the chunk in each slot
+
+	def read(row, nrow, slot):
+		t.getcolnp(column, indata[slot, :nrow], startrow=row, nrow=nrow)
+		rowinfo[slot]['times'] = t.getcol('TIME', startrow=row, nrow=nrow)
+		rowinfo[slot]['ant1'] = t.getcol('ANTENNA1', startrow=row, nrow=nrow)[:, numpy.newaxis]
+		rowinfo[slot]['ant2'] = t.getcol('ANTENNA2', startrow=row, nrow=nrow)[:, numpy.newaxis]
+
+	def compute(nrow, slot):
+		info = rowinfo[slot]
+		circ = circdata[slot % len(circdata), :nrow]
+		numpy.matmul(indata[slot, :nrow], lin2circT, out=circ)
+		bad = numpy.zeros(circ.shape[:2], dtype=bool) # (row, chan) with a non-finite correction
+		for invgains, soltimes, freqidx in corrections:
+			timeidx = nearest_index(soltimes, info['times'])[:, numpy.newaxis]
+			pols = numpy.minimum([pol1, pol2], invgains.shape[-1]-1)
+			correction = invgains[timeidx, freqidx, info['ant1']][..., pols[0]] * numpy.conj(invgains[timeidx, freqidx, info['ant2']][..., pols[1]])
+			circ *= correction
+			bad = bad | ~numpy.isfinite(correction).all(axis=-1)
+		numpy.matmul(circ, circ2linT, out=outdata[slot, :nrow])
+		info['bad'] = bad
+
+	def write(row, nrow, slot):
+		t.putcol(outcol, outdata[slot, :nrow], startrow=row, nrow=nrow)
+		if circcol is not None:
+			t.putcol(circcol, circdata[slot, :nrow], startrow=row, nrow=nrow)
+		bad = rowinfo[slot]['bad']
+		if bad.any():
+			flags = t.getcol('FLAG', startrow=row, nrow=nrow)
+			t.putcol('FLAG', flags | bad[..., numpy.newaxis], startrow=row, nrow=nrow)
+
+	pipeline_chunks(t, stepsize, read, compute, write)
+	t.close()
+
+def addcol(t, column, newcol, inms):
+	if newcol not in t.colnames():
+		print('Adding the output column',newcol,'to',inms)
+		desc = t.getcoldesc(column)
+		newdesc = pt.makecoldesc(newcol, desc)
+		newdmi = t.getdminfo(column)
+		newdmi['NAME'] = 'Dysco' + newcol
+		t.addcols(newdesc, newdmi)
+
 def main(options):
-	stepsize = 200000
-	cI = numpy.complex(0.,1.)
-	
 	inms = options.inms
 	if inms == '':
 			print('Error: you have to specify an input MS, use -h for help')
@@ -69,62 +306,22 @@ def main(options):
 	outcol = options.outcol
 	
 	t = pt.table(inms, readonly=False, ack=True)
+	if column not in t.colnames():
+		print('Error: Input column does not exist')
+		t.close()
+		return
 	if options.back:
-		lincol = options.lincol
-		if lincol not in t.colnames():
-			print('Adding the output linear polarization column',lincol,'to',inms)            
-			desc = t.getcoldesc(column)
-			newdesc = pt.makecoldesc(lincol, desc)
-			newdmi = t.getdminfo(column)
-			newdmi['NAME'] = 'Dysco' + lincol
-			t.addcols(newdesc, newdmi)  
-            
-
-                ### RVW EDIT 2012   
+		### RVW EDIT 2012 Input column with the -c switch
 		print('Reading the input column (circular)', column)
-		if column not in t.colnames():
-			print('Error: Input column does not exist')
-			return
-		for row in range(0,t.nrows(),stepsize):
-			print('Doing row', row, 'out of', t.nrows())
-			### RVW EDIT 2012 Input column with the -c switch 
-			cirdata = t.getcol(column, startrow=row, nrow=stepsize, rowincr=1)
-			#cirdata = t.getcol(outcol)
-			#print 'SHAPE ARRAY', numpy.shape(cirdata)
-            
-			print('Computing the linear polarization terms...')
-			lindata = numpy.transpose(numpy.array([
-                    0.5*(cirdata[:,:,0]+cirdata[:,:,1]+cirdata[:,:,2]+cirdata[:,:,3]),
-                    0.5*(cI*cirdata[:,:,0]-cI*cirdata[:,:,1]+cI*cirdata[:,:,2]-cI*cirdata[:,:,3]),
-                    0.5*(-cI*cirdata[:,:,0]-cI*cirdata[:,:,1]+cI*cirdata[:,:,2]+cI*cirdata[:,:,3]),
-                    0.5*(cirdata[:,:,0]-cirdata[:,:,1]-cirdata[:,:,2]+cirdata[:,:,3])]),
-                    (1,2,0))
-			print('Finishing up...')
-			t.putcol(lincol, lindata, startrow=row, nrow=stepsize, rowincr=1)
-		t.close()
+		addcol(t, column, options.lincol, inms)
+		print('Computing the linear polarization terms...')
+		convert_column(t, column, options.lincol, CIRC2LIN, options.max_memory)
 	else:
-		if outcol not in t.colnames():
-			print('Adding the output column',outcol,'to',inms)
-			desc = t.getcoldesc(column)
-			newdesc = pt.makecoldesc(outcol, desc)
-			newdmi = t.getdminfo(column)
-			newdmi['NAME'] = 'Dysco' + outcol
-			t.addcols(newdesc, newdmi)  			
-
 		print('Reading the input column (linear)', column)
-		for row in range(0,t.nrows(),stepsize):
-			print('Doing row', row, 'out of', t.nrows(), row+stepsize)
-			data = t.getcol(column, startrow=row, nrow=stepsize, rowincr=1)
-			print('Computing the output circular column')
-			outdata = numpy.transpose(numpy.array([
-                    0.5*(data[:,:,0]-cI*data[:,:,1]+cI*data[:,:,2]+data[:,:,3]),
-                    0.5*(data[:,:,0]+cI*data[:,:,1]+cI*data[:,:,2]-data[:,:,3]),
-                    0.5*(data[:,:,0]-cI*data[:,:,1]-cI*data[:,:,2]-data[:,:,3]),
-                    0.5*(data[:,:,0]+cI*data[:,:,1]-cI*data[:,:,2]+data[:,:,3])]),
-                    (1,2,0))
-			print('Finishing up...')
-			t.putcol(outcol, outdata, startrow=row, nrow=stepsize, rowincr=1)
-		t.close()
+		addcol(t, column, outcol, inms)
+		print('Computing the output circular column')
+		convert_column(t, column, outcol, LIN2CIRC, options.max_memory)
+	t.close()
 	if options.poltable:
 		print('Updating the POLARIZATION table...')
 		tp = pt.table(inms+'/POLARIZATION',readonly=False,ack=True)
@@ -134,13 +331,23 @@ def main(options):
 		   tp.putcol('CORR_TYPE',numpy.array([[9,10,11,12]],dtype=numpy.int32)) # FROM CIRC-->LIN
 		else:
 		   tp.putcol('CORR_TYPE',numpy.array([[5,6,7,8]],dtype=numpy.int32)) # FROM LIN-->CIRC
+		tp.close()
 
-opt = optparse.OptionParser()
-opt.add_option('-i','--inms',help='Input MS [no default]',default='')
-opt.add_option('-c','--column',help='Input column [default DATA]',default='DATA')
-opt.add_option('-o','--outcol',help='Output column [default DATA_CIRC]',default='DATA_CIRC')
-opt.add_option('-p','--poltable',help='Update POLARIZATION table? [default False]',default=False,action='store_true')
-opt.add_option('-b','--back',help='Go back to linear polarization [default False]',default=False,action='store_true')
-opt.add_option('-l','--lincol',help='Output linear polarization column, if the -b switch is used [default DATA_LIN]; we want to keep the original DATA column',default='DATA_LIN')
-options, arguments = opt.parse_args()
-main(options)
+if __name__ == '__main__':
+	opt = optparse.OptionParser()
+	opt.add_option('-i','--inms',help='Input MS [no default]',default='')
+	opt.add_option('-c','--column',help='Input column [default DATA]',default='DATA')
+	opt.add_option('-o','--outcol',help='Output column [default DATA_CIRC]',default='DATA_CIRC')
+	opt.add_option('-p','--poltable',help='Update POLARIZATION table? [default False]',default=False,action='store_true')
+	opt.add_option('-b','--back',help='Go back to linear polarization [default False]',default=False,action='store_true')
+	opt.add_option('-l','--lincol',help='Output linear polarization column, if the -b switch is used [default DATA_LIN]; we want to keep the original DATA column',default='DATA_LIN')
+	opt.add_option('-a','--applycal',help='Apply the phase000 and amplitude000 solutions of this h5parm in circular and go back to linear polarization in the --lincol column, in one pass [default none]',default='')
+	opt.add_option('-k','--circcol',help='With --applycal, also keep the corrected circular data in this column [default none]',default=None)
+	opt.add_option('-s','--solset',help='Solset of the --applycal h5parm [default sol000]',default='sol000')
+	opt.add_option('-m','--max_memory',help='Memory in MB for the conversion buffers [default a quarter of the available memory]',default=None,type='float')
+	options, arguments = opt.parse_args()
+	if options.applycal != '':
+		applycal_circular(options.inms, options.applycal, column=options.column, outcol=options.lincol,
+		                  solset=options.solset, max_memory=options.max_memory, circcol=options.circcol)
+	else:
+		main(options)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+ms_columns.py
+Make derived columns of a measurement set with vectorized functions that work on chunks of rows.
+
+Reading a full column with getcol does not fit in memory for full resolution LBA data. map_columns
+reads the input columns in chunks of rows into buffers that are allocated once, applies a function
+per output column and writes the result. Several output columns (also from different input columns)
+are made in the same pass, and the I/O of the neighbouring chunks overlaps with the computation
+(see pipeline_chunks in lin2circ.py). fill_column writes constant correlations (point source or
+phase difference models) in the same chunked way.
+
+EXAMPLE:
+from ms_columns import map_columns
+from BLsmooth import transform_phaseonly
+map_columns('test.ms', [('DATA', 'DATA_PHASEONLY', transform_phaseonly),
+                        ('MODEL_DATA', 'MODEL_DATA_PHASEONLY', transform_phaseonly)])
+
+A function gets a (rows, freq, pol) copy of the input chunk that it may change in place,
+and returns the array to be written.
+
+from ms_columns import fill_column
+fill_column('test.ms', 'MODEL_DATA_PDIFF', [0.5, 0., 0., 0.5])
+"""
+
+import numpy as np
+import pyrap.tables as pt
+from lin2circ import addcol, rows_per_chunk, pipeline_chunks
+
+
+def map_columns(ms, jobs, max_memory=None):
+    '''
+    Make output columns from input columns of a measurement set in one chunked pass
+    input: ms name, list of (input column, output column, function) and the memory in MB for the buffers
+           (default a quarter of the available memory)
+    '''
+    t = pt.table(ms, readonly=False, ack=True)
+    incols = list(dict.fromkeys([incol for incol, outcol, function in jobs]))
+    for incol, outcol, function in jobs:
+        addcol(t, incol, outcol, ms)
+    if t.nrows() == 0:
+        t.close()
+        return
+
+    # two slots of input and output buffers for the double buffered pipeline, plus the copy casacore makes
+    stepsize = min([rows_per_chunk(t, incol, max_memory, nbuffers=2*(len(incols) + len(jobs)) + 1) for incol in incols])
+    inbuffers, outbuffers = {}, []
+    for incol in incols:
+        cell = t.getcell(incol, 0)
+        inbuffers[incol] = np.empty((2, stepsize) + cell.shape, dtype=cell.dtype)
+    for incol, outcol, function in jobs:
+        outbuffers.append(np.empty_like(inbuffers[incol]))
+    results = [[None]*len(jobs), [None]*len(jobs)] # output of the functions per slot
+
+    def read(row, nrow, slot):
+        for incol in incols:
+            t.getcolnp(incol, inbuffers[incol][slot, :nrow], startrow=row, nrow=nrow)
+
+    def compute(nrow, slot):
+        for i, (incol, outcol, function) in enumerate(jobs):
+            data = outbuffers[i][slot, :nrow]
+            data[...] = inbuffers[incol][slot, :nrow]
+            results[slot][i] = function(data)
+
+    def write(row, nrow, slot):
+        for i, (incol, outcol, function) in enumerate(jobs):
+            t.putcol(outcol, results[slot][i], startrow=row, nrow=nrow)
+            results[slot][i] = None
+
+    pipeline_chunks(t, stepsize, read, compute, write)
+    t.close()
+
+
+def fill_column(ms, outcol, correlations, likecol='DATA', dysco=False, max_memory=None):
+    '''
+    Give every row and channel of a column the same correlations with one chunked write,
+    the column is added with the description of likecol if it does not exist
+    input: ms name, output column, value of each correlation (e.g. [0.5, 0, 0, 0.5]), column to copy the description from,
+           dysco=True compresses the new column with Dysco (like likecol), otherwise it gets a tiled storage manager
+           as the model columns DP3 adds, and the memory in MB for the buffer (default a quarter of the available memory)
+    '''
+    t = pt.table(ms, readonly=False, ack=True)
+    if t.nrows() == 0:
+        # there is no cell to get the shape of the tiles from, so the column gets the storage manager of likecol
+        addcol(t, likecol, outcol, ms)
+        t.close()
+        return
+    cell = t.getcell(likecol, 0)
+    if outcol not in t.colnames():
+        if dysco:
+            addcol(t, likecol, outcol, ms)
+        else:
+            print('Adding the output column', outcol, 'to', ms)
+            tileshape = np.array(cell.shape[::-1] + (max(1, 2**20//cell.nbytes),), dtype=np.int32)
+            t.addcols(pt.makecoldesc(outcol, t.getcoldesc(likecol)),
+                      {'TYPE': 'TiledShapeStMan', 'NAME': 'Tiled' + outcol, 'SPEC': {'DEFAULTTILESHAPE': tileshape}})
+
+    # the buffer is the same for every chunk, so it is filled only once
+    stepsize = rows_per_chunk(t, likecol, max_memory, nbuffers=2)
+    values = np.empty((stepsize,) + cell.shape, dtype=cell.dtype)
+    values[...] = np.asarray(correlations, dtype=cell.dtype)
+    nrows = t.nrows()
+    for row in range(0, nrows, stepsize):
+        nrow = min(stepsize, nrows - row)
+        t.putcol(outcol, values[:nrow], startrow=row, nrow=nrow)
+    t.close()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+ms_metadata.py
+Cached metadata of measurement sets (time axis, frequency axis, antenna names, phase center, maximum uvw distance).
+
+The pipelines open the same measurement set many times just to read one of these, and reading the
+full TIME column of a long observation to get the unique times is slow. Every item is read only once
+(the unique times with a TaQL DISTINCT), kept in memory and stored in a file inside the measurement
+set directory (<ms>/metadata.npz), so other processes and later runs do not have to read it again, and
+copying or removing the measurement set takes the cache along. casacore ignores the extra file.
+The cache is keyed on the path and the modification time of the measurement set tables, it is refreshed
+automatically when the measurement set changes.
+
+EXAMPLE:
+from ms_metadata import ms_metadata
+times = ms_metadata('test.ms', 'times')
+freqs = ms_metadata('test.ms', 'chan_freq')[0]
+
+Available items: times, chan_freq, chan_width, ref_frequency, antenna_names, phase_dir, uvwmax
+"""
+
+import os
+import numpy as np
+import pyrap.tables as pt
+
+_cache = {}  # absolute ms path --> (modification time, {item: value})
+
+
+def _read_times(ms):
+    t = pt.taql('SELECT DISTINCT TIME FROM ' + ms)
+    times = np.sort(t.getcol('TIME'))
+    t.close()
+    return {'times': times}
+
+def _read_spectral_window(ms):
+    t = pt.table(ms + '/SPECTRAL_WINDOW', readonly=True, ack=False)
+    items = {'chan_freq': t.getcol('CHAN_FREQ'), 'chan_width': t.getcol('CHAN_WIDTH'),
+             'ref_frequency': t.getcol('REF_FREQUENCY')}
+    t.close()
+    return items
+
+def _read_antenna(ms):
+    t = pt.table(ms + '/ANTENNA', readonly=True, ack=False)
+    names = np.array(t.getcol('NAME'), dtype=str)
+    t.close()
+    return {'antenna_names': names}
+
+def _read_field(ms):
+    t = pt.table(ms + '/FIELD', readonly=True, ack=False)
+    phase_dir = t.getcol('PHASE_DIR')
+    t.close()
+    return {'phase_dir': phase_dir}
+
+def _read_uvwmax(ms):
+    t = pt.taql('SELECT GMAX(SQRT(SUMSQR(UVW))) AS UVWMAX FROM ' + ms)
+    uvwmax = np.array(t.getcol('UVWMAX')[0], dtype=float)
+    t.close()
+    return {'uvwmax': uvwmax}
+
+_readers = {'times': _read_times,
+            'chan_freq': _read_spectral_window,
+            'chan_width': _read_spectral_window,
+            'ref_frequency': _read_spectral_window,
+            'antenna_names': _read_antenna,
+            'phase_dir': _read_field,
+            'uvwmax': _read_uvwmax}
+
+
+def sidecar_name(ms):
+    return os.path.join(os.path.abspath(ms), 'metadata.npz')
+
+def ms_mtime(ms):
+    '''
+    Modification time of the measurement set: newest of the table files we read from
+    (not the directory itself, writing the sidecar into it changes its modification time)
+    '''
+    paths = [os.path.join(ms, sub, 'table.dat') for sub in ['', 'SPECTRAL_WINDOW', 'ANTENNA', 'FIELD']]
+    return max([os.path.getmtime(path) for path in paths if os.path.exists(path)], default=0.)
+
+def _load_sidecar(filename, mtime):
+    if not os.path.isfile(filename):
+        return {}
+    try:
+        with np.load(filename, allow_pickle=False) as npz:
+            if float(npz['_mtime']) != mtime:
+                return {}
+            return {key: npz[key] for key in npz.files if key != '_mtime'}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+def _save_sidecar(filename, mtime, items):
+    tmpname = filename + '.tmp{:d}'.format(os.getpid())
+    try:
+        with open(tmpname, 'wb') as fobj:
+            np.savez(fobj, _mtime=mtime, **items)
+        os.replace(tmpname, filename)
+    except OSError:  # read-only location, only cache in memory
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def ms_metadata(ms, item):
+    '''
+    Return a metadata item of a measurement set, read from the cache if the measurement set did not change
+    input: ms name and one of: times, chan_freq, chan_width, ref_frequency, antenna_names, phase_dir, uvwmax
+    output: numpy array (uvwmax is a 0-d array)
+    '''
+    if item not in _readers:
+        raise ValueError('Unknown measurement set metadata item: ' + item)
+    msname = os.path.abspath(ms).rstrip('/')
+    mtime = ms_mtime(msname)
+    if msname not in _cache or _cache[msname][0] != mtime:
+        _cache[msname] = (mtime, _load_sidecar(sidecar_name(msname), mtime))
+    items = _cache[msname][1]
+    if item not in items:
+        items.update(_readers[item](msname))
+        _save_sidecar(sidecar_name(msname), mtime, items)
+    return items[item].copy()
@@ -0,0 +1,105 @@
+"""
+Shared fixtures for the tests, the scripts are imported from the folders they live in.
+Everything is fabricated on small synthetic h5parms and measurement sets, no real data is needed.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['DD', 'lofar_facet_selfcal', '']:
+    if os.path.join(ROOT, folder) not in sys.path:
+        sys.path.insert(0, os.path.join(ROOT, folder))
+
+ANTENNAS = ['CS001LBA', 'CS002LBA', 'RS106LBA', 'RS205LBA']
+TIMES = 4.8e9 + 8. * np.arange(20)
+FREQS = np.linspace(15e6, 30e6, 4)
+
+
+@pytest.fixture
+def make_h5():
+    """
+    Factory for a h5parm with one solset (sol000) with random solutions
+    input: file name, {direction name: [ra, dec]}, list of soltab names (phase000, amplitude000, tec000)
+    """
+    h5parm = pytest.importorskip('losoto.h5parm').h5parm
+    rng = np.random.default_rng(0)
+
+    def make(name, directions, soltabs, times=TIMES, freqs=FREQS):
+        name = str(name)
+        h5 = h5parm(name, readonly=False)
+        ss = h5.makeSolset('sol000')
+        ss.obj._f_get_child('antenna').append([(antenna, [0., 0., 0.]) for antenna in ANTENNAS])
+        ss.obj._f_get_child('source').append([(d, coords) for d, coords in directions.items()])
+        for soltab in soltabs:
+            soltype = soltab[:-3]
+            axes = {'time': times, 'freq': freqs, 'ant': ANTENNAS, 'dir': list(directions.keys()), 'pol': ['XX', 'YY']}
+            if soltype == 'tec':
+                axes.pop('pol')
+                axes['freq'] = freqs[:1]
+            shape = [len(vals) for vals in axes.values()]
+            vals = {'phase': rng.normal(size=shape), 'amplitude': 1. + 0.1 * rng.normal(size=shape),
+                    'tec': 0.01 * rng.normal(size=shape)}[soltype]
+            ss.makeSoltab(soltype, soltab, axesNames=list(axes.keys()), axesVals=list(axes.values()),
+                          vals=vals, weights=np.ones(shape))
+        h5.close()
+        return name
+
+    return make
+
+
+@pytest.fixture
+def make_ms():
+    """
+    Factory for a time-ordered measurement set with all baselines (including autocorrelations) in every timestep,
+    random DATA with some NaNs and flags, and WEIGHT_SPECTRUM. Half of the stations are in a compact core.
+    input: MS name, number of antennas, timesteps and channels
+    """
+    pt = pytest.importorskip('casacore.tables')
+    rng = np.random.default_rng(1)
+
+    def make(name, nant=len(ANTENNAS), ntime=20, nchan=8):
+        name = str(name)
+        baselines = [(ant1, ant2) for ant1 in range(nant) for ant2 in range(ant1, nant)]
+        nrows = ntime * len(baselines)
+        t = pt.default_ms(name)
+        t.addcols(pt.maketabdesc([pt.makearrcoldesc('DATA', 0j, ndim=2, valuetype='complex'),
+                                  pt.makearrcoldesc('WEIGHT_SPECTRUM', 0., ndim=2, valuetype='float')]))
+        t.addrows(nrows)
+        ant1 = np.tile([bl[0] for bl in baselines], ntime)
+        ant2 = np.tile([bl[1] for bl in baselines], ntime)
+        t.putcol('ANTENNA1', ant1)
+        t.putcol('ANTENNA2', ant2)
+        times = np.repeat(TIMES[0] + 8. * np.arange(ntime), len(baselines))
+        t.putcol('TIME', times)
+        t.putcol('TIME_CENTROID', times)
+        t.putcol('INTERVAL', np.full(nrows, 8.))
+        positions = rng.uniform(-30e3, 30e3, size=(nant, 3))
+        positions[:nant // 2] *= 0.02
+        t.putcol('UVW', positions[ant2] - positions[ant1])
+        data = (rng.normal(size=(nrows, nchan, 4)) + 1j * rng.normal(size=(nrows, nchan, 4))).astype(np.complex64)
+        data[rng.uniform(size=data.shape) < 0.01] = np.nan
+        t.putcol('DATA', data)
+        t.putcol('WEIGHT_SPECTRUM', rng.uniform(0.5, 1.5, size=data.shape).astype(np.float32))
+        t.putcol('FLAG', rng.uniform(size=data.shape) < 0.02)
+        t.close()
+
+        t = pt.table(name + '/ANTENNA', readonly=False, ack=False)
+        t.addrows(nant)
+        t.putcol('NAME', (ANTENNAS * nant)[:nant] if nant <= len(ANTENNAS) else ['ST{:03d}'.format(n) for n in range(nant)])
+        t.close()
+        t = pt.table(name + '/SPECTRAL_WINDOW', readonly=False, ack=False)
+        t.addrows(1)
+        chan_freqs = np.linspace(40e6, 60e6, nchan)
+        width = chan_freqs[1] - chan_freqs[0]
+        t.putcol('CHAN_FREQ', chan_freqs[np.newaxis])
+        t.putcol('CHAN_WIDTH', np.full((1, nchan), width))
+        t.putcol('RESOLUTION', np.full((1, nchan), width))
+        t.putcol('REF_FREQUENCY', np.array([chan_freqs.mean()]))
+        t.close()
+        return name
+
+    return make
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pt = pytest.importorskip('casacore.tables')
+import BLsmooth
+
+
+def baselines(ms):
+    with pt.table(ms, ack=False) as t:
+        BL = pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)) FROM $t GROUPBY ANTENNA1,ANTENNA2")
+        ants1, ants2, dists = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2'), BL.getcol('Col_3') / 1e3
+        BL.close()
+    return ants1, ants2, dists
+
+
+def test_default_sigmabin_shares_kernels(tmp_path, make_ms):
+    """
+    With the shipped defaults baselines of almost the same length are smoothed together with one cached kernel
+    """
+    ms = make_ms(tmp_path / 'test.ms', nant=24)
+    BLsmooth._kernels.clear()
+    BLsmooth.smooth_ms([ms])
+
+    buckets = BLsmooth.baseline_buckets(*baselines(ms))  # the options of the run above are still set
+    n_smoothed = sum([len(bls) for bls in buckets.values()])
+    assert n_smoothed > 100
+    assert len(buckets) < 0.8 * n_smoothed
+    # one kernel per bucket and axis at most, fewer if the time and frequency sigmas coincide
+    assert len(BLsmooth._kernels) <= 2 * len(buckets)
+    with pt.table(ms, ack=False) as t:
+        assert np.isfinite(t.getcol('SMOOTHED_DATA')).any()
+
+
+def test_exact_sigmas_do_not_share(tmp_path, make_ms):
+    ms = make_ms(tmp_path / 'test.ms', nant=24)
+    BLsmooth.smooth_ms(['-g', '0', ms])
+    buckets = BLsmooth.baseline_buckets(*baselines(ms))
+    assert all([len(bls) == 1 for bls in buckets.values()])
+
+
+def test_unsorted_ms_raises(tmp_path, make_ms):
+    ms = make_ms(tmp_path / 'test.ms')
+    with pt.table(ms, readonly=False, ack=False) as t:
+        t.putcol('TIME_CENTROID', t.getcol('TIME_CENTROID')[::-1])
+    with pytest.raises(ValueError, match='time-sorted'):
+        BLsmooth.smooth_ms([ms])
+    with pytest.raises(ValueError, match='Cannot find'):
+        BLsmooth.smooth_ms([str(tmp_path / 'missing.ms')])
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+tables = pytest.importorskip('tables')
+pytest.importorskip('casacore.tables')
+from h5_merger import merge_h5
+
+
+def read_directions(h5_name):
+    T = tables.open_file(h5_name)
+    sources = [(name.decode(), list(coords)) for name, coords in T.root.sol000.source[:]]
+    dirs = {soltab._v_name: [d.decode() for d in soltab.dir[:]] for soltab in T.root.sol000._f_iter_nodes('Group')}
+    T.close()
+    return sources, dirs
+
+
+def test_tec_not_converted_adds_no_directions(tmp_path, make_h5):
+    """
+    The tec solutions are not merged with convert_tec=False, so their directions should not be in the output
+    """
+    tec = make_h5(tmp_path / 'tec.h5', {'H0': [0.5, 0.45], 'H1': [0.55, 0.52]}, ['tec000'])
+    phase = make_h5(tmp_path / 'phase.h5', {'D0': [1.2, 0.6]}, ['phase000'])
+    h5_out = str(tmp_path / 'merged.h5')
+    merge_h5(h5_out=h5_out, h5_tables=[tec, phase], h5_time_freq=phase, convert_tec=False)
+
+    sources, dirs = read_directions(h5_out)
+    assert [name for name, coords in sources] == ['Dir00']
+    assert np.allclose(sources[0][1], [1.2, 0.6])
+    assert dirs == {'amplitude000': ['Dir00'], 'phase000': ['Dir00']}
+
+
+def test_tec_converted_keeps_its_directions(tmp_path, make_h5):
+    tec = make_h5(tmp_path / 'tec.h5', {'H0': [0.5, 0.45], 'H1': [0.55, 0.52]}, ['tec000'])
+    phase = make_h5(tmp_path / 'phase.h5', {'D0': [1.2, 0.6]}, ['phase000'])
+    h5_out = str(tmp_path / 'merged.h5')
+    merge_h5(h5_out=h5_out, h5_tables=[tec, phase], h5_time_freq=phase, convert_tec=True)
+
+    sources, dirs = read_directions(h5_out)
+    assert np.allclose([coords for name, coords in sources], [[0.5, 0.45], [0.55, 0.52], [1.2, 0.6]])
+    assert dirs['phase000'] == ['Dir00', 'Dir01', 'Dir02']
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pt = pytest.importorskip('casacore.tables')
+from lin2circ import LIN2CIRC, CIRC2LIN, convert_column, applycal_circular
+from ms_columns import map_columns, fill_column
+
+
+@pytest.fixture
+def empty_ms(tmp_path, make_ms):
+    return make_ms(tmp_path / 'empty.ms', ntime=0)
+
+
+def test_convert_column_round_trip(tmp_path, make_ms):
+    ms = make_ms(tmp_path / 'test.ms')
+    with pt.table(ms, readonly=False, ack=False) as t:
+        t.addcols(pt.makecoldesc('DATA_CIRC', t.getcoldesc('DATA')))
+        t.addcols(pt.makecoldesc('DATA_LIN', t.getcoldesc('DATA')))
+        convert_column(t, 'DATA', 'DATA_CIRC', LIN2CIRC, max_memory=0.01)
+        convert_column(t, 'DATA_CIRC', 'DATA_LIN', CIRC2LIN, max_memory=0.01)
+        data = t.getcol('DATA')
+        finite = np.isfinite(data).all(axis=-1)  # a NaN correlation makes all converted correlations NaN
+        assert np.allclose(t.getcol('DATA_CIRC')[finite], (data @ LIN2CIRC.T)[finite], atol=1e-5)
+        assert np.allclose(t.getcol('DATA_LIN')[finite], data[finite], atol=1e-5)
+
+
+def test_empty_ms(empty_ms):
+    """
+    An empty MS gets the output columns, without reading a first cell that does not exist
+    """
+    with pt.table(empty_ms, readonly=False, ack=False) as t:
+        t.addcols(pt.makecoldesc('DATA_CIRC', t.getcoldesc('DATA')))
+        convert_column(t, 'DATA', 'DATA_CIRC', LIN2CIRC)
+    map_columns(empty_ms, [('DATA', 'DATA_COPY', lambda data: data)])
+    fill_column(empty_ms, 'MODEL_DATA_PDIFF', [0.5, 0., 0., 0.5])
+    applycal_circular(empty_ms, 'unused.h5', outcol='CALCORRECT_DATA')
+    with pt.table(empty_ms, ack=False) as t:
+        assert t.nrows() == 0
+        assert {'DATA_CIRC', 'DATA_COPY', 'MODEL_DATA_PDIFF', 'CALCORRECT_DATA'} <= set(t.colnames())
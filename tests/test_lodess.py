@@ -0,0 +1,39 @@
+import os
+import re
+
+import numpy as np
+import pytest
+
+pt = pytest.importorskip('casacore.tables')
+pytest.importorskip('bdsf')
+pytest.importorskip('regions')
+import LoDeSS
+from lin2circ import LIN2CIRC
+
+
+def test_consolidated_target_reads_existing_columns(tmp_path, monkeypatch, make_ms, make_h5):
+    """
+    The columns the DPPP commands of consolidated_target read are made by apply_calibrator in individual_target
+    """
+    monkeypatch.chdir(tmp_path)
+    ms = make_ms(tmp_path / 'L123456_concat.ms')
+    make_h5(tmp_path / 'calibrator.h5', {'Dir00': [0., 0.]}, ['phase000', 'amplitude000'],
+            freqs=np.linspace(40e6, 60e6, 3))
+    LoDeSS.apply_calibrator(os.path.basename(ms))
+
+    commands = []
+    monkeypatch.setattr(LoDeSS, 'run_cmd', lambda cmd, **kwargs: commands.append(cmd))
+    monkeypatch.setattr(LoDeSS, 'generate_boxfile', lambda direction: None)
+    monkeypatch.setattr(LoDeSS, 'extract_directions', lambda target: None)
+    LoDeSS.consolidated_target('[123.4deg,56.3deg]')
+
+    dppp = [cmd for cmd in commands if cmd.startswith('DPPP') and 'msin=' + os.path.basename(ms) in cmd]
+    assert len(dppp) == 1
+    with pt.table(ms, ack=False) as t:
+        for column in re.findall(r'msin\.datacolumn=(\S+)', dppp[0]):
+            assert column in t.colnames()
+        circ, lin = t.getcol('CALCORRECT_DATA_CIRC'), t.getcol('CALCORRECT_DATA')
+    finite = np.isfinite(lin).all(axis=-1)
+    assert finite.any()
+    assert np.allclose(circ[finite], (lin @ LIN2CIRC.T)[finite], atol=1e-4)
+    assert os.path.isdir(tmp_path / 'DI_image')